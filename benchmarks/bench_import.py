@@ -0,0 +1,52 @@
+"""Cold import time of hitl_sdk, every sample runs in a fresh interpreter.
+
+    python benchmarks/bench_import.py --repeat 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY = ('numpy', 'PIL', 'aiohttp', 'dataclasses_json')
+
+SCRIPT = '''
+import json, sys, time
+started_at = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - started_at
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+CASES = [
+    ('import hitl_sdk', 'toloka', 'import hitl_sdk'),
+    ('hitl_sdk.SDK', 'toloka', 'import hitl_sdk; hitl_sdk.SDK'),
+    ('hitl_sdk.SDK', 'handl', 'import hitl_sdk; hitl_sdk.SDK'),
+    ('SDK + image libraries', 'handl', 'import hitl_sdk; hitl_sdk.SDK; import numpy, PIL.Image'),
+]
+
+
+def sample(statement: str, backend: str) -> dict:
+    env = dict(os.environ, HITL_BACKEND=backend)
+    out = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(statement=statement, heavy=HEAVY)],
+        env=env,
+    )
+    return json.loads(out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, backend, statement in CASES:
+        samples = [sample(statement, backend) for _ in range(args.repeat)]
+        elapsed = statistics.median(s['elapsed'] for s in samples)
+        loaded = ', '.join(samples[0]['loaded']) or '-'
+        print(f'{name:>32} [{backend:>6}]: {elapsed * 1000:7.1f} ms, loaded: {loaded}')
+
+
+if __name__ == '__main__':
+    main()
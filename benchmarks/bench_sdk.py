@@ -0,0 +1,188 @@
+"""End-to-end throughput and latency against the in-process mock servers from hitl_sdk.testing.
+
+    python benchmarks/bench_sdk.py --documents 200 --concurrency 20 --latency 0.01 --completion-delay 0.5
+
+With --memory every run also reports the peak of Python allocations made while it ran, traced with
+tracemalloc. Tracing slows the client and the mock server down, so compare throughput without it.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import time
+import tracemalloc
+from typing import Awaitable, Callable, List
+
+import numpy as np
+from PIL import Image
+
+from hitl_sdk.common import PollingPolicy, Task
+from hitl_sdk.handl import sdk as handl_sdk
+from hitl_sdk.handl.api import Handl
+from hitl_sdk.handl.manager import HandlDocumentManager
+from hitl_sdk.metrics import MetricsRegistry, format_prometheus, set_metrics
+from hitl_sdk.session import SessionPool
+from hitl_sdk.testing import MockHandl, MockServer, MockToloka
+from hitl_sdk.toloka.manager import TolokaDocumentManager
+from hitl_sdk.toloka.sdk import SDK as TolokaSDK
+
+FIELDS = 3
+
+_seeds = itertools.count()
+
+
+def make_jpeg(seed: int, size=(600, 200)) -> bytes:
+    pixels = np.random.RandomState(seed).randint(0, 255, (*size[::-1], 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def make_images() -> List[bytes]:
+    # Fresh content for every document, otherwise uploads are answered by the upload cache.
+    return [make_jpeg(next(_seeds)) for _ in range(FIELDS)]
+
+
+def make_tasks(images: List[bytes]) -> List[Task]:
+    return [
+        Task(images=[image], field_name=f'field_{i}', predict='predict')
+        for i, image in enumerate(images)
+    ]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def run(
+        name: str,
+        server: MockServer,
+        document: Callable[[int, List[bytes]], Awaitable],
+        documents: int,
+        concurrency: int,
+        memory: bool = False,
+):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    images = [make_images() for _ in range(documents)]
+
+    async def one(n: int):
+        async with semaphore:
+            started_at = time.perf_counter()
+            await document(n, images[n])
+            latencies.append(time.perf_counter() - started_at)
+
+    requests = sum(server.requests.values())
+    if memory:
+        # Started after the images are made, so only allocations of this run are counted.
+        tracemalloc.start()
+    started_at = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(documents)))
+    elapsed = time.perf_counter() - started_at
+    requests = sum(server.requests.values()) - requests
+
+    line = (
+        f'{name:>36}: {documents / elapsed:8.1f} docs/s, '
+        f'p50 {percentile(latencies, 0.5) * 1000:7.1f} ms, p99 {percentile(latencies, 0.99) * 1000:7.1f} ms, '
+        f'{requests / documents:5.1f} requests/doc'
+    )
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        line += f', peak traced alloc {peak / 1024 / 1024:6.1f} MB'
+    print(line)
+
+
+async def bench_toloka(args):
+    policy = PollingPolicy(initial=args.poll, minimum=args.poll / 2, maximum=args.poll * 4)
+    async with MockToloka(args.latency, args.error_rate, args.completion_delay) as server:
+        pool = SessionPool(limit=args.concurrency * 2, verify_ssl=False)
+
+        def sdk() -> TolokaSDK:
+            return TolokaSDK(host=server.url, pool=pool, polling_policy=policy, request_retry_strategy=(0.1,) * 5)
+
+        async def create_and_wait(n: int, images: List[bytes]):
+            await sdk().create_and_wait(make_tasks(images), document_type='bench', document_id=str(n))
+
+        async def create_document(n: int, images: List[bytes]):
+            client = sdk()
+            await client.create_document(images, document_type='bench', document_id=str(n))
+            await client.wait_until_complete()
+
+        manager = TolokaDocumentManager(sdk(), policy)
+
+        async def managed_document(n: int, images: List[bytes]):
+            await manager.create_and_wait(images, document_type='bench', document_id=str(n))
+
+        await run('toloka create_and_wait', server, create_and_wait, args.documents, args.concurrency, args.memory)
+        await run('toloka create_document+wait', server, create_document, args.documents, args.concurrency, args.memory)
+        await run('toloka DocumentManager', server, managed_document, args.documents, args.concurrency, args.memory)
+        await pool.close()
+
+
+async def bench_handl(args):
+    policy = PollingPolicy(initial=args.poll, minimum=args.poll / 2, maximum=args.poll * 4)
+    async with MockHandl(args.latency, args.error_rate, args.completion_delay) as server:
+        client = Handl(url=server.url, username='bench', password='bench', pool=SessionPool(limit_per_host=30))
+        client.poll_interval = args.poll
+        client.attempt_delay = 0.1
+        handl_sdk.set_handl(client)
+
+        def sdk() -> handl_sdk.SDK:
+            return handl_sdk.SDK(polling_policy=policy)
+
+        async def create_and_wait(n: int, images: List[bytes]):
+            await sdk().create_and_wait(make_tasks(images), document_type='bench', document_id=str(n))
+
+        async def create_document(n: int, images: List[bytes]):
+            client = sdk()
+            await client.create_document(images, document_type='bench', document_id=str(n), only_ocr=True)
+            await client.wait_until_complete()
+
+        async def annotate_bboxes(n: int, images: List[bytes]):
+            image = np.asarray(Image.open(io.BytesIO(images[0])))
+            await sdk().annotate_bboxes('bench', str(n), image, {'face': [(0., 0., .5, .5)]})
+
+        async def ocr_multiple(n: int, images: List[bytes]):
+            image = np.asarray(Image.open(io.BytesIO(images[0])))
+            await sdk().ocr_multiple('bench', str(n), image, ['name', 'date'])
+
+        manager = HandlDocumentManager(sdk(), policy)
+
+        async def managed_document(n: int, images: List[bytes]):
+            await manager.create_and_wait(images, document_type='bench', document_id=str(n), only_ocr=True)
+
+        await run('handl create_and_wait', server, create_and_wait, args.documents, args.concurrency, args.memory)
+        await run('handl create_document+wait', server, create_document, args.documents, args.concurrency, args.memory)
+        await run('handl DocumentManager', server, managed_document, args.documents, args.concurrency, args.memory)
+        await run('handl annotate_bboxes', server, annotate_bboxes, args.documents, args.concurrency, args.memory)
+        await run('handl ocr_multiple', server, ocr_multiple, args.documents, args.concurrency, args.memory)
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['toloka', 'handl', 'all'], default='all')
+    parser.add_argument('--documents', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.005, help='server latency per request, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--completion-delay', type=float, default=0.2, help='human time per task, seconds')
+    parser.add_argument('--poll', type=float, default=0.05, help='poll interval, seconds')
+    parser.add_argument('--metrics', action='store_true', help='print SDK metrics in Prometheus text format')
+    parser.add_argument('--memory', action='store_true', help='trace peak Python allocations of every run')
+    args = parser.parse_args()
+
+    registry = set_metrics(MetricsRegistry()) if args.metrics else None
+
+    if args.backend in ('toloka', 'all'):
+        asyncio.run(bench_toloka(args))
+    if args.backend in ('handl', 'all'):
+        asyncio.run(bench_handl(args))
+    if registry is not None:
+        print(format_prometheus(registry))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import timeit
+
+from dataclasses_json.core import _decode_dataclass
+
+from hitl_sdk.common import Task
+
+
+def make_item(i: int) -> dict:
+    return {
+        'id': f'5de6a7b54597480001c1d{i:03d}',
+        'state': 'completed',
+        'document_type': 'passport',
+        'document_id': 'doc',
+        'field_name': f'field_{i}',
+        'predict': 'ИВАНОВ',
+        'predict_confidence': 0.42,
+        'result': 'ИВАНОВ',
+        'type': 'standard',
+        'deadline_at': '2019-12-06T21:10:46.123456+00:00',
+        'created_at': '2019-12-06T21:00:46.123456Z',
+        'completed_at': '2019-12-06T21:05:46.123456+00:00',
+    }
+
+
+def main(number: int = 20):
+    items = [make_item(i) for i in range(500)]
+    document = dict(make_item(0), tasks=items)
+
+    for name, payload in [('task', items), ('document with 500 tasks', [document])]:
+        reflective = timeit.timeit(
+            lambda: [_decode_dataclass(Task, item, False) for item in payload],
+            number=number,
+        )
+        fast = timeit.timeit(lambda: [Task.from_dict(item) for item in payload], number=number)
+        count = len(items) * number
+        print(
+            f'{name:>24}: dataclasses_json {reflective / count * 1e6:7.1f} us/task, '
+            f'fast path {fast / count * 1e6:7.1f} us/task, speedup x{reflective / fast:.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,37 @@
-from .common import Task
 from .env import HITL_BACKEND
-from .handl.sdk import SDK as HandlSDK
-from .toloka.sdk import SDK as TolokaSDK
-
-if HITL_BACKEND == 'toloka':
-    SDK = TolokaSDK
-elif HITL_BACKEND == 'handl':
-    SDK = HandlSDK
-else:
-    raise AssertionError('HITL_BACKEND env value is not in list: [toloka, handl]')
+
+__all__ = [
+    'SDK', 'HandlSDK', 'TolokaSDK', 'DocumentManager', 'HandlDocumentManager', 'TolokaDocumentManager',
+    'Task', 'SessionPool',
+]
+
+
+def __getattr__(name: str):
+    # Backends are imported on first access, so only the one in use is loaded.
+    if name in ('SDK', 'DocumentManager'):
+        if HITL_BACKEND == 'toloka':
+            value = __getattr__(f'Toloka{name}')
+        elif HITL_BACKEND == 'handl':
+            value = __getattr__(f'Handl{name}')
+        else:
+            raise AssertionError('HITL_BACKEND env value is not in list: [toloka, handl]')
+    elif name == 'TolokaSDK':
+        from .toloka.sdk import SDK as value
+    elif name == 'HandlSDK':
+        from .handl.sdk import SDK as value
+    elif name == 'TolokaDocumentManager':
+        from .toloka.manager import TolokaDocumentManager as value
+    elif name == 'HandlDocumentManager':
+        from .handl.manager import HandlDocumentManager as value
+    elif name == 'Task':
+        from .common import Task as value
+    elif name == 'SessionPool':
+        from .session import SessionPool as value
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,13 +1,21 @@
+import asyncio
 import base64
 import datetime
-from dataclasses import dataclass, field
+import functools
+import hashlib
+import random
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field, fields
 from io import BytesIO
 from logging import getLogger
-from typing import Iterable, List, Optional, Union, Dict
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union, Dict
 
 import dataclasses_json
 import dateutil.parser
-from PIL import Image
+
+from . import tracing
+from .metrics import get_metrics
 
 Value = Union[str, List[str]]
 
@@ -15,36 +23,209 @@ Value = Union[str, List[str]]
 logging = getLogger('docr.hitl-sdk')
 
 
-def concat_v(images: List[Union[bytes, str]]):
-    imgs = []
-    for i in images:
-        if isinstance(i, str):
-            i = base64.b64decode(i.encode())
-        imfile = BytesIO(i)
-        im = Image.open(imfile)
-        imgs.append(im)
+def decode_image(image: Union[bytes, str]) -> bytes:
+    if isinstance(image, str):
+        image = base64.b64decode(image.encode())
+    return image
+
+
+def images_digest(images: List[Union[bytes, str]]) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    for image in images:
+        h.update(hashlib.blake2b(decode_image(image), digest_size=20).digest())
+    return h.hexdigest()
+
+
+def _fit_width(size: Tuple[int, int], max_width: Optional[int]) -> Tuple[int, int]:
+    width, height = size
+    if max_width is None or width <= max_width:
+        return size
+    return max_width, max(1, round(height * max_width / width))
+
+
+def _jpeg_options(quality: Optional[int], subsampling: Optional[int]) -> Dict[str, int]:
+    options = {}
+    if quality is not None:
+        options['quality'] = quality
+    if subsampling is not None:
+        options['subsampling'] = subsampling
+    return options
 
-    width = max(i.width for i in imgs)
-    height = sum(i.height for i in imgs)
+
+def concat_v(
+        images: List[Union[bytes, str]],
+        max_width: Optional[int] = None,
+        quality: Optional[int] = None,
+        subsampling: Optional[int] = None,
+) -> bytes:
+    from PIL import Image
+
+    raw = [decode_image(i) for i in images]
+
+    # Image.open only parses headers, pixels are decoded on paste one image at a time.
+    sizes = []
+    for i in raw:
+        with Image.open(BytesIO(i)) as im:
+            size = _fit_width(im.size, max_width)
+            if (
+                    len(raw) == 1 and quality is None and subsampling is None
+                    and im.format == 'JPEG' and im.mode == 'RGB' and size == im.size
+            ):
+                return i
+        sizes.append(size)
+
+    width = max(w for w, _ in sizes)
+    height = sum(h for _, h in sizes)
 
     dst = Image.new('RGB', (width, height))
 
     y = 0
-    for i in imgs:
-        dst.paste(i, (0, y))
-        y += i.height
+    for i, size in zip(raw, sizes):
+        with Image.open(BytesIO(i)) as im:
+            if im.size != size:
+                im.draft('RGB', size)
+                im = im.resize(size)
+            dst.paste(im, (0, y))
+        y += size[1]
 
     img = BytesIO()
-    dst.save(img, format='JPEG')
+    dst.save(img, format='JPEG', **_jpeg_options(quality, subsampling))
     img = img.getvalue()
 
     return img
 
 
+def encode_jpeg(image, quality: Optional[int] = None, subsampling: Optional[int] = None) -> bytes:
+    from PIL import Image
+
+    img = BytesIO()
+    Image.fromarray(image, "RGB").save(img, format='JPEG', **_jpeg_options(quality, subsampling))
+    return img.getvalue()
+
+
+async def prepare_image(
+        func: Callable[..., bytes],
+        *args: Any,
+        executor: Optional[Executor] = None,
+        **kwargs: Any,
+) -> bytes:
+    # Decoding and encoding images holds the loop for tens of ms, so run it in a thread/process pool.
+    loop = asyncio.get_event_loop()
+    with tracing.span('prepare_image', op=func.__name__), \
+            get_metrics().timer('hitl_image_seconds', op=func.__name__):
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
 def default_retry_strategy() -> Iterable:
     return 5, 30
 
 
+def parse_datetime(value: Union[None, str, datetime.datetime]) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        if value.endswith('Z'):
+            return datetime.datetime.fromisoformat(value[:-1] + '+00:00')
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return dateutil.parser.parse(value)
+
+
+def to_naive_utc(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+@dataclass
+class PollingPolicy:
+    initial: float = 5.
+    maximum: float = 60.
+    minimum: float = 1.
+    multiplier: float = 1.5
+    jitter: float = 0.1
+    # Overall wait budget in seconds, None waits until every task is completed.
+    max_wait: Optional[float] = None
+
+    def backoff(self, interval: float) -> float:
+        return min(interval * self.multiplier, self.maximum)
+
+    def delay(self, interval: float, deadline_at: Optional[datetime.datetime] = None, now=None) -> float:
+        if deadline_at is not None:
+            if now is None:
+                now = datetime.datetime.utcnow()
+            remaining = (to_naive_utc(deadline_at) - now).total_seconds()
+            # Poll at least twice in the time left, so the deadline is not overslept.
+            interval = min(interval, max(remaining / 2, self.minimum))
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(interval, self.minimum)
+
+
+def observe_task_wait(task: 'Task', backend: str):
+    if task.created_at and task.completed_at:
+        wait = to_naive_utc(task.completed_at) - to_naive_utc(task.created_at)
+        get_metrics().observe('hitl_task_wait_seconds', wait.total_seconds(), backend=backend)
+
+
+def _autocomplete(sdk, tasks: List['Task'], now: datetime.datetime, deadline_at: Optional[datetime.datetime] = None):
+    for task in tasks:
+        task.autocomplete_by_deadline(now, deadline_at=deadline_at)
+        if task.completed_at:
+            # Autocompleted tasks are never polled again, so nothing else releases their memo keys.
+            sdk._forget_memo(task)
+
+
+def _in_flight(sdk) -> List['Task']:
+    in_flight = list(sdk.tasks.in_flight().values())
+    if sdk.document and not sdk.document.completed_at:
+        in_flight.append(sdk.document)
+    return in_flight
+
+
+async def wait_for_completion(sdk, policy: PollingPolicy) -> None:
+    started_at = time.monotonic()
+    budget_deadline = None
+    if policy.max_wait is not None:
+        budget_deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=policy.max_wait)
+    interval = policy.initial
+
+    while True:
+        in_work = sdk.in_work_count()
+        if not sum(in_work):
+            break
+
+        in_flight = _in_flight(sdk)
+
+        if budget_deadline is not None and time.monotonic() - started_at >= policy.max_wait:
+            sdk.logger.warning(f'HITL: wait budget {policy.max_wait}s is over, {len(in_flight)} tasks left')
+            # The budget is measured on the monotonic clock, so complete everything left regardless of wall time.
+            now = datetime.datetime.utcnow()
+            _autocomplete(sdk, in_flight, now, deadline_at=now)
+            sdk.tasks.reconcile()
+            break
+
+        deadlines = [to_naive_utc(task.deadline_at) for task in in_flight if task.deadline_at]
+        if budget_deadline is not None:
+            deadlines.append(budget_deadline)
+        await asyncio.sleep(policy.delay(interval, min(deadlines) if deadlines else None))
+
+        with tracing.span('poll', tasks=in_work[0], documents=in_work[1]):
+            if in_work[1]:
+                sdk.logger.debug(f'HITL: In work {in_work[1]} document. Sync...')
+                updated = await sdk.sync_document()
+            else:
+                sdk.logger.debug(f'HITL: In work {in_work[0]} tasks. Sync...')
+                updated = await sdk.sync_tasks()
+
+        with tracing.span('reconcile'):
+            _autocomplete(sdk, _in_flight(sdk), datetime.datetime.utcnow())
+            sdk.tasks.reconcile()
+
+        interval = policy.initial if updated else policy.backoff(interval)
+
+
 @dataclasses_json.dataclass_json
 @dataclass
 class DocumentStruct:
@@ -66,20 +247,20 @@ class Task:
     deadline_at: Optional[datetime.datetime] = field(
         default=None,
         metadata=dataclasses_json.config(
-            decoder=lambda x: dateutil.parser.parse(x) if x else None
+            decoder=parse_datetime
         )
     )
 
     created_at: Optional[datetime.datetime] = field(
         default=None,
         metadata=dataclasses_json.config(
-            decoder=lambda x: dateutil.parser.parse(x) if x else None
+            decoder=parse_datetime
         ),
     )
     completed_at: Optional[datetime.datetime] = field(
         default=None,
         metadata=dataclasses_json.config(
-            decoder=lambda x: dateutil.parser.parse(x) if x else None
+            decoder=parse_datetime
         ),
     )
 
@@ -97,11 +278,20 @@ class Task:
     field_name: Optional[str] = None
     is_checkbox_array: bool = False
     code: Optional[str] = None
+    # Set by release_payload, identifies the images once their bytes are dropped.
+    image_hash: Optional[str] = None
 
     def __post_init__(self):
-        if self.image:
+        if self.image and self.image not in self.images:
             self.images.append(self.image)
 
+    def release_payload(self):
+        if self.images and self.image_hash is None:
+            self.image_hash = images_digest(self.images)
+        self.image = None
+        self.images = []
+        self.uncut_images = []
+
     def get_result(self) -> Optional[Value]:
         if self.completed_at:
             return self.result
@@ -110,12 +300,48 @@ class Task:
     def is_timeout(self) -> bool:
         return self.state and 'timeout' in self.state
 
-    def autocomplete_by_deadline(self, now=None):
+    def autocomplete_by_deadline(self, now=None, deadline_at: Optional[datetime.datetime] = None):
         if now is None:
             now = datetime.datetime.utcnow()
         # logging.debug(f'hitl:autocomplete_by_deadline deadline_at={self.deadline_at} now={now} id={self.id}')
-        if self.deadline_at:
-            if now >= self.deadline_at:
+        deadlines = [to_naive_utc(d) for d in (self.deadline_at, deadline_at) if d]
+        if deadlines:
+            if now >= min(deadlines):
                 self.state = 'docr_deadline:timeout'
                 self.completed_at = now
                 self.result = self.result or self.predict or ''
+
+
+_TASK_FIELDS = frozenset(f.name for f in fields(Task))
+_TASK_DATETIME_FIELDS = ('deadline_at', 'created_at', 'completed_at')
+
+
+def _task_from_dict(cls, kvs: Union[Dict, Task], *, infer_missing=False) -> Task:
+    # Hand-written equivalent of the dataclasses_json decoder, it runs for every polled task.
+    if isinstance(kvs, Task):
+        return kvs
+
+    kwargs = {k: v for k, v in kvs.items() if k in _TASK_FIELDS}
+    for name in _TASK_DATETIME_FIELDS:
+        if name in kwargs:
+            kwargs[name] = parse_datetime(kwargs[name])
+
+    structure = kwargs.get('document_structure')
+    if isinstance(structure, dict):
+        kwargs['document_structure'] = DocumentStruct(
+            document_type=structure.get('document_type'),
+            fields=structure.get('fields'),
+        )
+
+    tasks = kwargs.get('tasks')
+    if tasks:
+        kwargs['tasks'] = [cls.from_dict(task) for task in tasks]
+
+    # __post_init__ appends `image` to `images`, keep the caller's list intact.
+    if kwargs.get('images'):
+        kwargs['images'] = list(kwargs['images'])
+
+    return cls(**kwargs)
+
+
+Task.from_dict = classmethod(_task_from_dict)
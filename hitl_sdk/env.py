@@ -10,3 +10,5 @@ HANDL_GROUP = os.getenv('HANDL_GROUP', '7Z')
 HANDL_PREFIX = os.getenv('HANDL_PREFIX', 'HITL')
 HANDL_VERSION = os.getenv('HANDL_VERSION')
 HANDL_TASK_TIMEOUT = float(os.getenv('HANDL_TASK_TIMEOUT', 3600))
+HANDL_PROJECT_CACHE = os.getenv('HANDL_PROJECT_CACHE')  # path to a json file shared between workers
+HANDL_PROJECT_CACHE_TTL = float(os.getenv('HANDL_PROJECT_CACHE_TTL', 3600))
@@ -1,14 +1,20 @@
 import asyncio
 import json
 import logging
+import re
 import time
 from datetime import date
 from enum import Enum
-from typing import Any, Callable, Dict, Union, List
+from typing import Any, Callable, Dict, Optional, Tuple, Union, List
 
 import aiohttp.client_exceptions
-from aiohttp.client import ClientSession
 
+from .. import tracing
+from ..metrics import get_metrics
+from ..session import SessionPool
+from .cache import UploadCache
+from .poller import ResultPoller
+from .projects import ProjectRegistry
 from .specs import get_ocr_spec, get_bboxes_spec, get_ocr_multiple_spec
 
 
@@ -47,6 +53,16 @@ def default_version_factory():
 class Handl:
     attempts = 30
     attempt_delay = 1
+    poll_interval = 10
+    # A poller not refreshed or waited on for this many poll intervals is dropped.
+    poller_idle_polls = 10
+    token_ttl = 600
+    token_refresh_margin = 60
+    login_attempts = 10
+    login_delay = 0.5
+    login_max_delay = 30
+    # Set when the backend honours `offset` on /projects/{id}/result.
+    results_offset_supported = False
 
     def __init__(
             self,
@@ -56,6 +72,9 @@ class Handl:
             prefix: str = 'HITL',
             version: Version = None,
             group: str = ProjectGroup.dev.value,
+            pool: Optional[SessionPool] = None,
+            upload_cache: Optional[UploadCache] = None,
+            projects: Optional[ProjectRegistry] = None,
     ):
         self._url = url
         self._username = username
@@ -65,37 +84,86 @@ class Handl:
         self._group = group
         self._jwt_token_cached = None
         self._jwt_token_created_at = time.time()
-        self._projects = {}
-
-    async def _jwt_token(self) -> str:
-        if time.time() - self._jwt_token_created_at > 600:
-            self._jwt_token_cached = None
-
-        if self._jwt_token_cached is not None:
-            return self._jwt_token_cached
-
-        while True:
-            async with ClientSession() as sess:
-                creds = dict(username=self._username, password=self._password)
-                url = f'{self._url}/login?captcha_id=&solution='
-                async with sess.post(url, json=creds) as resp:
-                    data = await resp.json()
-
-                if data.get('error') == 'Incorrect CAPTCHA':
-                    logging.info('incorrect captcha. retry.')
-                    continue
-
-                if 'token' not in data:
-                    logging.error(data)
-
+        self._token_refresh: Optional[asyncio.Future] = None
+        self._projects = projects if projects is not None else ProjectRegistry()
+        self._project_lookups: Dict[str, asyncio.Future] = {}
+        self._pool = pool or SessionPool(limit_per_host=30)
+        self._pollers: Dict[str, ResultPoller] = {}
+        self.upload_cache = upload_cache if upload_cache is not None else UploadCache()
+        self._uploading: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    @property
+    def pool(self) -> SessionPool:
+        return self._pool
+
+    def use_pool(self, pool: SessionPool):
+        self._pool = pool
+
+    async def close(self):
+        await self._pool.close()
+
+    async def __aenter__(self) -> 'Handl':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _jwt_token(self, stale: Optional[str] = None) -> str:
+        age = time.time() - self._jwt_token_created_at
+        if (
+                self._jwt_token_cached is None
+                or age > self.token_ttl
+                or (stale is not None and stale == self._jwt_token_cached)
+        ):
+            with tracing.span('token'):
+                return await asyncio.shield(self._refresh_token())
+
+        if age > self.token_ttl - self.token_refresh_margin:
+            # Refresh ahead of expiry in background, callers keep using the current token meanwhile.
+            self._refresh_token()
+        return self._jwt_token_cached
+
+    def _refresh_token(self) -> asyncio.Future:
+        # Single flight: every caller waits for the same login.
+        if self._token_refresh is None:
+            self._token_refresh = asyncio.ensure_future(self._login())
+            self._token_refresh.add_done_callback(self._token_refreshed)
+        return self._token_refresh
+
+    def _token_refreshed(self, fut: asyncio.Future):
+        self._token_refresh = None
+        if not fut.cancelled() and fut.exception() is not None:
+            logging.error(f'handl login failed: {fut.exception()!r}')
+
+    async def _login(self) -> str:
+        delay = self.login_delay
+        for _ in range(self.login_attempts):
+            creds = dict(username=self._username, password=self._password)
+            url = f'{self._url}/login?captcha_id=&solution='
+            async with self._pool.session.post(url, json=creds) as resp:
+                data = await resp.json()
+
+            get_metrics().inc('hitl_logins_total', backend='handl', ok='token' in data)
+            if 'token' in data:
                 self._jwt_token_cached = data['token']
                 self._jwt_token_created_at = time.time()
                 return self._jwt_token_cached
 
-    async def _auth_headers(self) -> Dict[str, str]:
+            if data.get('error') == 'Incorrect CAPTCHA':
+                logging.info('incorrect captcha. retry.')
+            else:
+                logging.error(data)
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.login_max_delay)
+
+        raise PermissionError(f'cannot login to {self._url} as {self._username}')
+
+    async def _auth_headers(self, stale: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        stale_token = stale and stale['authorization'][len('Bearer '):]
         for _ in range(self.attempts):
             try:
-                token = await self._jwt_token()
+                token = await self._jwt_token(stale=stale_token)
                 return {'authorization': f'Bearer {token}'}
             except aiohttp.client_exceptions.ClientConnectionError:
                 await asyncio.sleep(self.attempt_delay)
@@ -122,6 +190,7 @@ class Handl:
             return f'{prefix}__ocr_multiple__{document_type}__' + '__'.join(labels)
         raise AssertionError('invalid operation type')
 
+    @tracing.traced('project_lookup', 'operation', 'document_type')
     async def get_or_create_project(
             self,
             operation: OperationType,
@@ -131,14 +200,37 @@ class Handl:
     ) -> Dict[str, Any]:
         title = self._get_title(operation, document_type, labels)
 
-        if from_cache and title in self._projects:
-            return self._projects[title]
+        if from_cache:
+            project = self._projects.get(title)
+            if project is not None:
+                return project
+
+        # Single flight: concurrent callers wait for one lookup instead of creating duplicate projects.
+        lookup = self._project_lookups.get(title)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._lookup_project(title, operation, document_type, labels))
+            self._project_lookups[title] = lookup
+            lookup.add_done_callback(lambda _: self._project_lookups.pop(title, None))
+        return await asyncio.shield(lookup)
 
-        if title in self._projects:
-            project_id = self._projects['id']
-            projects = [await self._get_project(project_id)]
+    async def _lookup_project(
+            self,
+            title: str,
+            operation: OperationType,
+            document_type: str = None,
+            labels: List[str] = None,
+    ) -> Dict[str, Any]:
+        cached = self._projects.get(title)
+        if cached is not None:
+            project = await self._get_project(cached['id'])
+            if project is None:
+                raise ConnectionError(f'cannot get project {cached["id"]} on {self._url}')
+            projects = [project]
         else:
             projects = await self._list_projects()
+            if projects is None:
+                raise ConnectionError(f'cannot list projects on {self._url}')
+            self._projects.index(projects, ProjectState.online.value)
 
         for project in projects:
             if project['title'] == title and project['state'] == ProjectState.online.value:
@@ -149,7 +241,7 @@ class Handl:
             project = await self._create_project(title, spec)
             project = await self._set_project_state(project['id'], ProjectState.online)
 
-        self._projects[title] = project
+        self._projects.put(title, project)
         return project
 
     async def _create_project(self, title: str, spec: Dict[str, Any]) -> Dict[str, Any]:
@@ -170,29 +262,113 @@ class Handl:
         return await self._request(url, json=state.value, method='PUT')
 
     async def create_task(self, name: str, content: bytes, text: str, project_id: str):
-        url = f'{self._url}/projects/{project_id}/url?file={name}'
-        data = await self._request(url)
-
-        logging.debug(f'upload image: {data}')
-
-        async with ClientSession() as sess:
-            async with sess.put(data['uri'], data=content) as resp:
-                await resp.read()
-
+        # Upload errors are raised here, unlike create_tasks_bulk which reports a failed item as None.
+        data = await self._upload(asyncio.Semaphore(1), name, content, project_id)
         data['text'] = text or ""
+        resp = await self._register_dataset(project_id, [data])
+        if not resp:
+            raise ConnectionError(f'cannot create task {name} in handl project {project_id}')
+        return resp[0]
 
-        logging.debug(f'create task on handl: {data}')
+    async def create_tasks_bulk(
+            self,
+            items: List[Tuple[str, bytes, Optional[str]]],
+            project_id: str,
+            max_concurrency: int = 10,
+    ) -> List[Optional[Dict[str, Any]]]:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        uploads = await asyncio.gather(
+            *(self._upload(semaphore, name, content, project_id) for name, content, _ in items),
+            return_exceptions=True,
+        )
+
+        dataset = []
+        for (name, _, text), data in zip(items, uploads):
+            if isinstance(data, asyncio.CancelledError):
+                raise data
+            if isinstance(data, BaseException) or data is None:
+                logging.error(f'upload image {name} failed: {data!r}')
+                continue
+            data['text'] = text or ""
+            dataset.append(data)
+
+        if not dataset:
+            return [None] * len(items)
+
+        created = iter(await self._register_dataset(project_id, dataset))
+        return [
+            next(created, None) if isinstance(data, dict) else None
+            for data in uploads
+        ]
+
+    async def _register_dataset(self, project_id: str, dataset: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        logging.debug(f'create {len(dataset)} tasks on handl')
 
         url = f'{self._url}/projects/{project_id}/dataset'
-        resp = await self._request(url, json=data, method='POST')
-        return resp[0]
+        with tracing.span('register_dataset', items=len(dataset)):
+            return await self._request(url, json=dataset, method='POST') or []
+
+    async def _upload(
+            self,
+            semaphore: asyncio.Semaphore,
+            name: str,
+            content: bytes,
+            project_id: str,
+    ) -> Dict[str, Any]:
+        digest = UploadCache.digest(content)
+
+        # Identical images in flight at the same time share one upload.
+        key = (project_id, digest)
+        uploading = self._uploading.get(key)
+        if uploading is not None:
+            data = dict(await asyncio.shield(uploading))
+            self.upload_cache.hit(len(content))
+            return data
+
+        data = self.upload_cache.get(project_id, digest, len(content))
+        if data is not None:
+            logging.debug(f'image {name} already uploaded: {data}')
+            return data
+
+        uploading = asyncio.get_event_loop().create_future()
+        self._uploading[key] = uploading
+        try:
+            async with semaphore:
+                with tracing.span('upload', file=name, size=len(content)):
+                    url = f'{self._url}/projects/{project_id}/url?file={name}'
+                    data = await self._request(url)
+
+                    logging.debug(f'upload image: {data}')
+
+                    metrics = get_metrics()
+                    with metrics.timer('hitl_upload_seconds', backend='handl'):
+                        async with self._pool.session.put(data['uri'], data=content) as resp:
+                            resp.raise_for_status()
+                            await resp.read()
+                    metrics.inc('hitl_upload_bytes_total', len(content), backend='handl')
+        except asyncio.CancelledError:
+            uploading.cancel()
+            raise
+        except BaseException as e:
+            uploading.set_exception(e)
+            # Waiters re-raise it; nobody may be waiting, so mark it retrieved.
+            uploading.exception()
+            raise
+        finally:
+            del self._uploading[key]
+
+        self.upload_cache.put(project_id, digest, data)
+        uploading.set_result(dict(data))
+        return data
 
     async def _get_project(self, project_id: str) -> Dict[str, Any]:
         url = f'{self._url}/projects/{project_id}'
         return await self._request(url)
 
-    async def get_results(self, project_id: str):
+    async def get_results(self, project_id: str, offset: Optional[int] = None):
         url = f'{self._url}/projects/{project_id}/result'
+        if offset:
+            return await self._request(url, params={'offset': offset})
         return await self._request(url)
 
     async def get_tasks(self, project_id: str):
@@ -203,25 +379,71 @@ class Handl:
         url = f'{self._url}/users/me/owned_groups'
         return await self._request(url)
 
+    def poller(self, project_id: str) -> ResultPoller:
+        if project_id not in self._pollers:
+            # Projects come and go with document types and labels, drop pollers unused for a while.
+            # Polls without waiters (sync_tasks, get_result) keep a poller alive through refresh.
+            for pid, poller in list(self._pollers.items()):
+                if poller.idle(self.poll_interval * self.poller_idle_polls):
+                    del self._pollers[pid]
+            self._pollers[project_id] = ResultPoller(self, project_id, interval=self.poll_interval)
+        return self._pollers[project_id]
+
+    async def wait_result(self, project_id: str, task_id: str) -> Dict[str, Any]:
+        # Polls are shared between tasks and traced on their own, this span is the wait of one task.
+        with tracing.span('wait_result', project_id=project_id, task_id=task_id):
+            return await self.poller(project_id).wait(task_id)
+
     async def get_result(self, project_id: str, task_id: str):
-        results = await self.get_results(project_id)
-        for result in results:
-            if task_id == result['id']:
-                return result['payload']['text']
+        poller = self.poller(project_id)
+        if task_id not in poller.index:
+            await poller.refresh(max_age=0)
+        result = poller.index.get(task_id)
+        if result is not None:
+            return result['payload']['text']
 
     async def _request(self, url: str, method: str = 'GET', **kw) -> Any:
+        metrics = get_metrics()
+        labels = dict(backend='handl', method=method, endpoint=_endpoint(url[len(self._url):]))
+        if metrics.enabled and kw.get('json') is not None:
+            metrics.inc('hitl_request_sent_bytes_total', len(json.dumps(kw['json'])), **labels)
+
         headers = await self._auth_headers()
-        for _ in range(self.attempts):
+        relogged = False
+        for attempt in range(self.attempts):
+            if attempt:
+                metrics.inc('hitl_request_retries_total', **labels)
+            status = 'error'
             try:
-                async with ClientSession() as sess:
-                    async with sess.request(
+                with metrics.in_flight('hitl_requests_in_flight', **labels), \
+                        metrics.timer('hitl_request_seconds', **labels):
+                    async with self._pool.session.request(
                             method=method,
                             url=url,
                             headers=headers,
                             **kw,
                     ) as resp:
-                        if resp.content_type == 'application/octet-stream':
-                            return json.loads(await resp.read())
-                        return await resp.json()
+                        status = str(resp.status)
+                        if resp.status != 401:
+                            content = await resp.read()
+                            metrics.inc('hitl_request_received_bytes_total', len(content), **labels)
+                            if resp.content_type == 'application/octet-stream':
+                                return json.loads(content)
+                            return await resp.json()
             except aiohttp.client_exceptions.ClientConnectionError:
                 await asyncio.sleep(self.attempt_delay)
+                continue
+            finally:
+                metrics.inc('hitl_requests_total', status=status, **labels)
+
+            # Got 401 and the response is released. The token was revoked or expired early,
+            # log in again unless another request already did, but only once per request.
+            if relogged:
+                raise PermissionError(f'{method} {url} is unauthorized after a fresh login')
+            relogged = True
+            headers = await self._auth_headers(stale=headers)
+
+
+def _endpoint(path: str) -> str:
+    # Metrics are labelled per route, not per project.
+    return re.sub(r'/projects/[^/?]+', '/projects/{id}', path.split('?', 1)[0])
@@ -0,0 +1,55 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class UploadCache:
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = 3600.):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: 'OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def digest(content: bytes) -> str:
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+    def get(self, project_id: str, digest: str, size: int = 0) -> Optional[Dict[str, Any]]:
+        key = (project_id, digest)
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hit(size)
+        return dict(entry[1])
+
+    def hit(self, size: int = 0):
+        self.hits += 1
+        self.bytes_saved += size
+
+    def put(self, project_id: str, digest: str, data: Dict[str, Any]):
+        key = (project_id, digest)
+        self._entries[key] = (time.monotonic(), dict(data))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+        }
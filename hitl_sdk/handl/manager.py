@@ -0,0 +1,20 @@
+from typing import List
+
+from ..common import Task
+from ..manager import DocumentManager
+from .api import OperationType
+from .sdk import get_handl
+
+
+class HandlDocumentManager(DocumentManager):
+    async def _poll(self, documents: List[Task]) -> bool:
+        # Every document is a task in the ocr project, one results fetch answers all of them.
+        handl = get_handl()
+        project = await handl.get_or_create_project(OperationType.ocr)
+        results = await handl.poller(project['id']).refresh()
+
+        updated = False
+        for document in documents:
+            if await self.sdk._sync_task(results, document):
+                updated = True
+        return updated
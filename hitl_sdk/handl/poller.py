@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from .. import tracing
+
+
+class ResultPoller:
+    def __init__(self, handl, project_id: str, interval: float = 10.):
+        self._handl = handl
+        self.project_id = project_id
+        self.interval = interval
+        self.index: Dict[str, Dict[str, Any]] = {}
+        self._cursor = 0
+        self._last_id: Optional[str] = None
+        self._fetched_at = 0.
+        self._inflight: Optional[asyncio.Future] = None
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._runner: Optional[asyncio.Task] = None
+        # Last refresh or wait, an unused poller may be dropped together with its index.
+        self.used_at = time.monotonic()
+
+    async def refresh(self, max_age: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        self.used_at = time.monotonic()
+        if max_age is None:
+            max_age = self.interval
+        if time.monotonic() - self._fetched_at < max_age:
+            return self.index
+
+        # Single flight: every caller during a fetch shares its response.
+        if self._inflight is None:
+            # Shared by every caller, so it runs outside any caller's trace.
+            self._inflight = contextvars.Context().run(asyncio.ensure_future, self._fetch())
+            self._inflight.add_done_callback(self._clear_inflight)
+        return await asyncio.shield(self._inflight)
+
+    def _clear_inflight(self, fut: asyncio.Future):
+        if self._inflight is fut:
+            self._inflight = None
+
+    async def _fetch(self) -> Dict[str, Dict[str, Any]]:
+        with tracing.span('poll_results', project_id=self.project_id, waiters=len(self._waiters)) as span:
+            if self._handl.results_offset_supported:
+                new = await self._handl.get_results(self.project_id, offset=self._cursor) or []
+                if new:
+                    self._cursor += len(new)
+                    self._last_id = new[-1]['id']
+            else:
+                new = self._skip_seen(await self._handl.get_results(self.project_id) or [])
+            span.tag(results=len(new))
+
+        for result in new:
+            self.index[result['id']] = result
+
+        self._fetched_at = time.monotonic()
+        self._resolve()
+        return self.index
+
+    def _skip_seen(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Results are append-only, so a full download only needs its tail past the cursor.
+        cursor = self._cursor
+        if not cursor or (len(results) >= cursor and results[cursor - 1]['id'] == self._last_id):
+            new = results[cursor:]
+        else:
+            new = [result for result in results if result['id'] not in self.index]
+        # The cursor is the length of the downloaded list, whichever way its tail was found.
+        self._cursor = len(results)
+        self._last_id = results[-1]['id'] if results else None
+        return new
+
+    def _resolve(self):
+        for task_id in list(self._waiters):
+            result = self.index.get(task_id)
+            if result is None:
+                continue
+            for fut in self._waiters.pop(task_id):
+                if not fut.done():
+                    fut.set_result(result)
+
+    def wait(self, task_id: str) -> asyncio.Future:
+        self.used_at = time.monotonic()
+        fut = asyncio.get_event_loop().create_future()
+        result = self.index.get(task_id)
+        if result is not None:
+            fut.set_result(result)
+            return fut
+
+        self._waiters.setdefault(task_id, []).append(fut)
+        if self._runner is None or self._runner.done():
+            self._runner = contextvars.Context().run(asyncio.ensure_future, self._run())
+        return fut
+
+    def _has_waiters(self) -> bool:
+        for task_id, futures in list(self._waiters.items()):
+            futures[:] = [fut for fut in futures if not fut.done()]
+            if not futures:
+                del self._waiters[task_id]
+        return bool(self._waiters)
+
+    def idle(self, max_age: float) -> bool:
+        if self._has_waiters() or self._inflight is not None or not (self._runner is None or self._runner.done()):
+            return False
+        return time.monotonic() - self.used_at > max_age
+
+    async def _run(self):
+        while self._has_waiters():
+            try:
+                await self.refresh(max_age=self.interval / 2)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'poll results of project {self.project_id} failed: {e!r}')
+            if not self._has_waiters():
+                break
+            logging.info(f'HITL: wait for {len(self._waiters)} tasks in project {self.project_id}')
+            await asyncio.sleep(self.interval)
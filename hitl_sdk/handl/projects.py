@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+
+class ProjectRegistry:
+    def __init__(self, path: Optional[str] = None, ttl: float = 3600.):
+        self.path = path
+        self.ttl = ttl
+        self._projects: Dict[str, Dict[str, Any]] = {}
+
+    def get(self, title: str) -> Optional[Dict[str, Any]]:
+        project = self._projects.get(title)
+        if project is None and self.path:
+            entry = self._read().get(title)
+            if entry and time.time() - entry['stored_at'] <= self.ttl:
+                project = self._projects[title] = entry['project']
+        return project
+
+    def put(self, title: str, project: Dict[str, Any]):
+        self._projects[title] = project
+        if self.path:
+            self._write({title: project})
+
+    def index(self, projects: List[Dict[str, Any]], state: str):
+        # A listing already has every project, so remember all of them, not only the requested title.
+        found = {
+            project['title']: project
+            for project in projects
+            if project.get('state') == state
+        }
+        self._projects.update(found)
+        if self.path and found:
+            self._write(found)
+
+    def discard(self, title: str):
+        self._projects.pop(title, None)
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f'cannot read handl project cache {self.path}: {e!r}')
+            return {}
+
+    def _write(self, projects: Dict[str, Dict[str, Any]]):
+        now = time.time()
+        entries = {
+            title: entry
+            for title, entry in self._read().items()
+            if now - entry['stored_at'] <= self.ttl
+        }
+        entries.update({
+            title: {'project': project, 'stored_at': now}
+            for title, project in projects.items()
+        })
+        # Write to a temp file and rename, so other processes never read a partial file.
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.handl-projects-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning(f'cannot write handl project cache {self.path}: {e!r}')
@@ -2,30 +2,67 @@ import asyncio
 import base64
 import json
 import logging
-from io import BytesIO
-from dataclasses import dataclass, field
-from datetime import datetime
+from concurrent.futures import Executor
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
 from logging import getLogger, Logger
-from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING, Union
 from uuid import uuid4
 
-import numpy
-import numpy as np
-from PIL import Image
-
 from .api import Handl, OperationType
-from ..common import default_retry_strategy, Task, concat_v, DocumentStruct
-from ..env import (HANDL_GATEWAY, HANDL_GROUP, HANDL_PASSWORD, HANDL_PREFIX, HANDL_TASK_TIMEOUT, HANDL_USERNAME,
-                   HANDL_VERSION, SUGGESTIONS_GATEWAY)
+from .projects import ProjectRegistry
+from ..common import (default_retry_strategy, Task, concat_v, DocumentStruct, encode_jpeg, observe_task_wait,
+                      PollingPolicy, prepare_image, wait_for_completion)
+from ..memo import ResultCache
+from .. import tracing
+from ..metrics import get_metrics
+from ..store import TaskStore
+from ..env import (HANDL_GATEWAY, HANDL_GROUP, HANDL_PASSWORD, HANDL_PREFIX, HANDL_PROJECT_CACHE,
+                   HANDL_PROJECT_CACHE_TTL, HANDL_TASK_TIMEOUT, HANDL_USERNAME, HANDL_VERSION, SUGGESTIONS_GATEWAY)
+from ..session import SessionPool
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Shared by the module-level client; pass it as `pool=` to other Handl instances to reuse connections.
+pool = SessionPool(limit_per_host=30)
+
+_handl: Optional[Handl] = None
+
+
+def get_handl() -> Handl:
+    # Old code replaces the client by assigning `sdk.handl`, that assignment still wins.
+    client = globals().get('handl')
+    if client is not None:
+        return client
+
+    # The client is built from env on first use, importing the module does not need HANDL_* set.
+    global _handl
+    if _handl is None:
+        _handl = Handl(
+            url=HANDL_GATEWAY,
+            username=HANDL_USERNAME,
+            password=HANDL_PASSWORD,
+            prefix=HANDL_PREFIX,
+            version=HANDL_VERSION,
+            group=HANDL_GROUP,
+            pool=pool,
+            projects=ProjectRegistry(HANDL_PROJECT_CACHE, ttl=HANDL_PROJECT_CACHE_TTL),
+        )
+    return _handl
+
 
-handl = Handl(
-    url=HANDL_GATEWAY,
-    username=HANDL_USERNAME,
-    password=HANDL_PASSWORD,
-    prefix=HANDL_PREFIX,
-    version=HANDL_VERSION,
-    group=HANDL_GROUP,
-)
+def set_handl(client: Optional[Handl]):
+    global _handl
+    _handl = client
+    globals().pop('handl', None)
+
+
+def __getattr__(name: str):
+    # `handl` used to be a module-level client.
+    if name == 'handl':
+        return get_handl()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 @dataclass
@@ -34,21 +71,49 @@ class SDK:
     token: Optional[str] = None
     license_id: Optional[str] = None
     system_info_token: Optional[str] = None
-    tasks: Dict[str, Task] = field(default_factory=dict)
+    tasks: TaskStore = field(default_factory=TaskStore)
     document: Optional[Task] = None
     request_retry_strategy: Optional[Iterable] = default_retry_strategy()
     logger: Logger = getLogger('docr.hitl-sdk')
     suggestions_gateway: Optional[str] = SUGGESTIONS_GATEWAY
     confidence_threshold: Optional[Any] = None
+    polling_policy: Optional[PollingPolicy] = None
+    max_concurrency: int = 10
+    # None runs image preparation in the loop's default thread pool.
+    image_executor: Optional[Executor] = None
+    max_image_width: Optional[int] = None
+    jpeg_quality: Optional[int] = None
+    jpeg_subsampling: Optional[int] = None
+    result_cache: Optional[ResultCache] = None
+    # Drop image bytes from tasks once they are uploaded, only Task.image_hash is kept.
+    release_payloads: bool = True
+    _memo_keys: Dict[str, str] = field(default_factory=dict, init=False, repr=False)
+    # Span of the last create_tasks/create_document call, waiting for its results is traced under it.
+    _trace: Optional[tracing.Span] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if not isinstance(self.tasks, TaskStore):
+            self.tasks = TaskStore(self.tasks)
+
+    async def _prepare_concat(self, images: List[Union[bytes, str]]) -> bytes:
+        return await prepare_image(
+            concat_v,
+            images,
+            executor=self.image_executor,
+            max_width=self.max_image_width,
+            quality=self.jpeg_quality,
+            subsampling=self.jpeg_subsampling,
+        )
 
+    @tracing.traced('annotate_bboxes', 'document_type', 'document_id')
     async def annotate_bboxes(
             self,
             document_type: str,
             document_id: str,
-            image: np.ndarray,
+            image: 'np.ndarray',
             labels: Dict[str, List[Tuple[float, float, float, float]]],
     ) -> Dict[str, List[Tuple[float, float, float, float]]]:
-        project = await handl.get_or_create_project(
+        project = await get_handl().get_or_create_project(
             OperationType.bboxes,
             document_type=document_type,
             labels=list(labels.keys()),
@@ -58,24 +123,26 @@ class SDK:
         uid = str(uuid4())
         name = f'{document_type}__{document_id}__{uid}.jpg'
 
-        img = BytesIO()
-        Image.fromarray(image, "RGB").save(img, format='JPEG')
-        content = img.getvalue()
+        content = await prepare_image(
+            encode_jpeg,
+            image,
+            executor=self.image_executor,
+            quality=self.jpeg_quality,
+            subsampling=self.jpeg_subsampling,
+        )
 
         predict = json.dumps(labels)
-        img = await handl.create_task(name, content, predict, pid)
+        img = await get_handl().create_task(name, content, predict, pid)
         task_id = img['id']
 
-        while True:
-            results = await handl.get_results(pid)
-            for result in results:
-                if task_id == result['id']:
-                    result = result['payload']['aabb']
-                    logging.debug(result)
-                    return result
-            self.logger.info(f'HITL: wait for {name}')
-            await asyncio.sleep(10)
+        self.logger.info(f'HITL: wait for {name}')
+        with get_metrics().timer('hitl_task_wait_seconds', backend='handl'):
+            result = await get_handl().wait_result(pid, task_id)
+        result = result['payload']['aabb']
+        logging.debug(result)
+        return result
 
+    @tracing.traced('create_tasks', 'document_type', 'document_id')
     async def create_tasks(
             self,
             tasks: List[Task],
@@ -85,30 +152,83 @@ class SDK:
             mock: bool = False,
             processing_type: Optional[str] = None,
             document_structure: DocumentStruct = None,
+            only_created: bool = False,
     ) -> List[Task]:
-        project = await handl.get_or_create_project(OperationType.ocr)
+        self._trace = tracing.current_span()
+        project = await get_handl().get_or_create_project(OperationType.ocr)
         pid = project['id']
 
-        for task in tasks:
-            if not task.images:
-                continue
-            if (
-                    self.confidence_threshold is not None
-                    and task.predict_confidence is not None
-                    and task.predict_confidence >= self.confidence_threshold
-            ):
+        pending = [
+            task
+            for task in tasks
+            if task.images and not (
+                self.confidence_threshold is not None
+                and task.predict_confidence is not None
+                and task.predict_confidence >= self.confidence_threshold
+            )
+        ]
+
+        created_tasks = []
+        memo_keys = []
+        if self.result_cache is not None:
+            sent = []
+            for task in pending:
+                key, hit = self.result_cache.lookup(task, document_type)
+                if hit:
+                    task.id = task.id or str(uuid4())
+                    if self.release_payloads:
+                        task.release_payload()
+                    self.tasks[task.id] = task
+                    created_tasks.append(task)
+                else:
+                    sent.append(task)
+                    memo_keys.append(key)
+            pending = sent
+
+        async def prepare(task: Task) -> bytes:
+            with tracing.span('task', field_name=task.field_name):
+                return await self._prepare_concat(task.images)
+
+        contents = await asyncio.gather(*(prepare(task) for task in pending), return_exceptions=True)
+
+        prepared = []
+        items = []
+        for i, (task, content) in enumerate(zip(pending, contents)):
+            if isinstance(content, asyncio.CancelledError):
+                raise content
+            if isinstance(content, BaseException):
+                # One broken crop must not fail the rest of the batch.
+                self.logger.error(f'HITL: failed to prepare image for {task.field_name}: {content!r}')
+                task.state = 'error'
                 continue
             uid = str(uuid4())
             name = f'{document_type}__{document_id}__{task.field_name}__{uid}.jpg'
-            content = concat_v(task.images)
-            img = await handl.create_task(name, content, task.predict, pid)
-            task_id = img['id']
-            task.id = task_id
-            task.created_at = datetime.utcnow()
-            self.tasks[task_id] = task
+            items.append((name, content, task.predict))
+            prepared.append((task, memo_keys[i] if memo_keys else None))
 
+        created = []
+        if items:
+            created = await get_handl().create_tasks_bulk(items, pid, max_concurrency=self.max_concurrency)
+
+        for (task, memo_key), img in zip(prepared, created):
+            if img is None:
+                self.logger.error(f'HITL: failed to create task for {task.field_name}')
+                task.state = 'error'
+                continue
+            task.id = img['id']
+            task.created_at = datetime.utcnow()
+            if self.release_payloads:
+                task.release_payload()
+            self.tasks[task.id] = task
+            created_tasks.append(task)
+            if memo_key is not None:
+                self._memo_keys[task.id] = memo_key
+
+        if only_created:
+            return created_tasks
         return list(self.tasks.values())
 
+    @tracing.traced('create_document', 'document_type', 'document_id')
     async def create_document(
             self,
             images: List[Union[bytes, str]],
@@ -121,19 +241,46 @@ class SDK:
             processing_type: Optional[str] = None,
             deadline_at: datetime = None,
     ) -> Optional[Dict[str, Any]]:
+        self._trace = tracing.current_span()
+        self.document = await self.submit_document(
+            images,
+            document_type=document_type,
+            document_id=document_id,
+            only_classify=only_classify,
+            only_ocr=only_ocr,
+            integrity_check=integrity_check,
+            mock=mock,
+            processing_type=processing_type,
+            deadline_at=deadline_at,
+        )
+        return self.document
+
+    async def submit_document(
+            self,
+            images: List[Union[bytes, str]],
+            document_type: Optional[str] = None,
+            document_id: Optional[str] = None,
+            only_classify: bool = False,
+            only_ocr: bool = False,
+            integrity_check: bool = False,
+            mock: bool = False,
+            processing_type: Optional[str] = None,
+            deadline_at: datetime = None,
+    ) -> Task:
+        # Same as create_document, but the document is not the one this SDK waits for.
         if only_classify or integrity_check or not only_ocr:
             raise AssertionError('hitl with handl backend supports only_ocr=True mode only')
 
-        project = await handl.get_or_create_project(OperationType.ocr)
+        project = await get_handl().get_or_create_project(OperationType.ocr)
         pid = project['id']
 
         uid = str(uuid4())
         name = f'{document_type}__{document_id}__{uid}.jpg'
-        content = concat_v(images)
-        img = await handl.create_task(name, content, '', pid)
+        content = await self._prepare_concat(images)
+        img = await get_handl().create_task(name, content, '', pid)
         task_id = img['id']
 
-        self.document = Task(
+        document = Task(
             id=task_id,
             document_type=document_type,
             document_id=document_id,
@@ -141,16 +288,19 @@ class SDK:
             image=images[0],
             images=images,
         )
-        return self.document
+        if self.release_payloads:
+            document.release_payload()
+        return document
 
+    @tracing.traced('ocr_multiple', 'document_type', 'document_id')
     async def ocr_multiple(
             self,
             document_type: str,
             document_id: str,
-            image: np.ndarray,
+            image: 'np.ndarray',
             labels: List[str],
     ) -> Dict[str, str]:
-        project = await handl.get_or_create_project(
+        project = await get_handl().get_or_create_project(
             OperationType.ocr_multiple,
             document_type=document_type,
             labels=labels,
@@ -160,106 +310,112 @@ class SDK:
         uid = str(uuid4())
         name = f'{document_type}__{document_id}__{uid}.jpg'
 
-        img = BytesIO()
-        Image.fromarray(image, "RGB").save(img, format='JPEG')
-        content = img.getvalue()
+        content = await prepare_image(
+            encode_jpeg,
+            image,
+            executor=self.image_executor,
+            quality=self.jpeg_quality,
+            subsampling=self.jpeg_subsampling,
+        )
 
-        img = await handl.create_task(name, content, '', pid)
+        img = await get_handl().create_task(name, content, '', pid)
         task_id = img['id']
 
-        while True:
-            results = await handl.get_results(pid)
-            for result in results:
-                if task_id == result['id']:
-                    result = result['payload']['ocrs']
-                    logging.debug(result)
-                    return result
-            self.logger.info(f'HITL: wait for {name}')
-            await asyncio.sleep(10)
-
-    async def _sync_task(self, results: List[Dict[str, Any]], task: Task) -> List[Task]:
-        if not task.completed_at:
-            lifetime = (datetime.utcnow() - task.created_at).total_seconds()
-            if lifetime > HANDL_TASK_TIMEOUT:
-                task.state = 'timeout'
-
-        for result in results:
-            task_id = result['id']
-            if task_id in task.id:
-                task.result = result['payload']['text']
-                task.completed_at = datetime.utcnow().isoformat()
-                return [task]
-
-        return []
+        self.logger.info(f'HITL: wait for {name}')
+        with get_metrics().timer('hitl_task_wait_seconds', backend='handl'):
+            result = await get_handl().wait_result(pid, task_id)
+        result = result['payload']['ocrs']
+        logging.debug(result)
+        return result
+
+    async def _sync_task(self, results: Dict[str, Dict[str, Any]], task: Task) -> List[Task]:
+        if task.completed_at:
+            return []
+
+        result = results.get(task.id)
+        if result is None:
+            task.autocomplete_by_deadline(deadline_at=task.created_at + timedelta(seconds=HANDL_TASK_TIMEOUT))
+            if task.completed_at:
+                self._forget_memo(task)
+            return []
+
+        task.result = result['payload']['text']
+        task.completed_at = datetime.utcnow()
+        observe_task_wait(task, 'handl')
+        self._memoize(task.id, task)
+        return [task]
+
+    def _forget_memo(self, task: Task):
+        self._memo_keys.pop(task.id, None)
+
+    def _memoize(self, key: str, task: Task):
+        memo_key = self._memo_keys.pop(key, None)
+        if memo_key is not None and self.result_cache is not None and not task.is_timeout():
+            self.result_cache.set(memo_key, task.result)
 
     async def sync_document(self):
         try:
-            project = await handl.get_or_create_project(OperationType.ocr)
+            project = await get_handl().get_or_create_project(OperationType.ocr)
             pid = project['id']
 
-            results = await handl.get_results(pid)
+            results = await get_handl().poller(pid).refresh()
 
             return await self._sync_task(results, self.document)
         except KeyboardInterrupt:
             raise
         except Exception as e:
-            print(e)
+            self.logger.warning(f'HITL: sync failed: {e!r}')
             return []
 
     async def sync_tasks(self) -> bool:
         try:
-            project = await handl.get_or_create_project(OperationType.ocr)
+            project = await get_handl().get_or_create_project(OperationType.ocr)
             pid = project['id']
 
-            results = await handl.get_results(pid)
+            results = await get_handl().poller(pid).refresh()
 
             res = []
-            for task in self.tasks.values():
+            for task in list(self.tasks.in_flight().values()):
                 res.extend(await self._sync_task(results, task))
+            self.tasks.reconcile()
 
             return bool(res)
         except KeyboardInterrupt:
             raise
         except Exception as e:
-            print(e)
+            self.logger.warning(f'HITL: sync failed: {e!r}')
             return False
 
     def in_work_count(self) -> Tuple[int, int]:
         return (
-            sum(
-                1
-                for v in self.tasks.values()
-                if not v.completed_at
-            ),
+            self.tasks.in_work_count(),
             int(bool(
                 self.document and not self.document.completed_at
             )),
         )
 
-    async def wait_until_complete(self, timeout: float = 5.) -> List[Task]:
-        while True:
-            in_work = self.in_work_count()
-            if not sum(in_work):
-                break
-
-            await asyncio.sleep(timeout)
-
-            if in_work[1]:
-                print(f'HITL: In work {in_work[1]} document. Sync...')
-                await self.sync_document()
-            else:
-                print(f'HITL: In work {in_work[0]} tasks. Sync...')
-                await self.sync_tasks()
-        return list(self.tasks.values())
+    async def wait_until_complete(
+            self,
+            timeout: float = 5.,
+            max_wait: Optional[float] = None,
+            policy: Optional[PollingPolicy] = None,
+    ) -> List[Task]:
+        policy = policy or self.polling_policy or PollingPolicy(initial=timeout)
+        if max_wait is not None:
+            policy = replace(policy, max_wait=max_wait)
+        with self.tasks.hold(), tracing.span('wait_until_complete', parent=self._trace):
+            await wait_for_completion(self, policy)
+            return list(self.tasks.values())
 
     async def create_and_wait(
             self,
             tasks: List[Task], document_type: Optional[str] = None,
             timeout: float = 5., **kwargs
     ) -> List[Task]:
-        await self.create_tasks(
-            tasks=tasks,
-            document_type=document_type,
-            **kwargs,
-        )
-        return await self.wait_until_complete(timeout=timeout)
+        with self.tasks.hold():
+            await self.create_tasks(
+                tasks=tasks,
+                document_type=document_type,
+                **kwargs,
+            )
+            return await self.wait_until_complete(timeout=timeout)
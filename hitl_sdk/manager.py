@@ -0,0 +1,117 @@
+import asyncio
+import contextvars
+import datetime
+from typing import Dict, List, Optional, Union
+
+from . import tracing
+from .common import PollingPolicy, Task, to_naive_utc
+
+
+class DocumentManager:
+    def __init__(self, sdk, policy: Optional[PollingPolicy] = None):
+        self.sdk = sdk
+        self.policy = policy or sdk.polling_policy or PollingPolicy()
+        # In-flight documents by id, a document is dropped once it is completed.
+        self.documents: Dict[str, Task] = {}
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._runner: Optional[asyncio.Future] = None
+
+    async def create_document(self, images: List[Union[bytes, str]], **kwargs) -> Task:
+        document = await self.sdk.submit_document(images, **kwargs)
+        self.track(document)
+        return document
+
+    async def create_and_wait(self, images: List[Union[bytes, str]], **kwargs) -> Task:
+        document = await self.create_document(images, **kwargs)
+        return await self.wait(document)
+
+    def track(self, document: Task):
+        if not document.completed_at:
+            self.documents[document.id] = document
+
+    def wait(self, document: Task) -> asyncio.Future:
+        fut = asyncio.get_event_loop().create_future()
+        document = self.documents.get(document.id, document)
+        if document.completed_at:
+            fut.set_result(document)
+            return fut
+
+        self.track(document)
+        self._waiters.setdefault(document.id, []).append(fut)
+        if self._runner is None or self._runner.done():
+            # One loop polls for every caller, run it outside the caller's trace.
+            self._runner = contextvars.Context().run(asyncio.ensure_future, self._run())
+        return fut
+
+    def in_work_count(self) -> int:
+        return len(self.documents)
+
+    async def _poll(self, documents: List[Task]) -> bool:
+        raise NotImplementedError()
+
+    def _update(self, document: Task):
+        if document.id in self.documents:
+            self.documents[document.id] = document
+
+    def _forget(self, document: Task):
+        pass
+
+    def _has_waiters(self) -> bool:
+        for document_id, futures in list(self._waiters.items()):
+            futures[:] = [fut for fut in futures if not fut.done()]
+            if not futures:
+                del self._waiters[document_id]
+        return bool(self._waiters)
+
+    def _resolve(self):
+        for document in [document for document in self.documents.values() if document.completed_at]:
+            del self.documents[document.id]
+            self._forget(document)
+            for fut in self._waiters.pop(document.id, []):
+                if not fut.done():
+                    fut.set_result(document)
+
+    def _fail(self, error: BaseException):
+        for futures in self._waiters.values():
+            for fut in futures:
+                if fut.done():
+                    continue
+                if isinstance(error, asyncio.CancelledError):
+                    fut.cancel()
+                else:
+                    fut.set_exception(error)
+        self._waiters.clear()
+
+    async def _run(self):
+        # Nobody else resolves the waiters, hand them the failure instead of leaving them hanging.
+        try:
+            await self._run_polls()
+        except asyncio.CancelledError as e:
+            self._fail(e)
+            raise
+        except Exception as e:
+            self.sdk.logger.error(f'HITL: document polling failed: {e!r}')
+            self._fail(e)
+
+    async def _run_polls(self):
+        interval = self.policy.initial
+        while self._has_waiters():
+            deadlines = [to_naive_utc(d.deadline_at) for d in self.documents.values() if d.deadline_at]
+            await asyncio.sleep(self.policy.delay(interval, min(deadlines) if deadlines else None))
+
+            documents = list(self.documents.values())
+            with tracing.span('poll_documents', documents=len(documents)):
+                try:
+                    updated = await self._poll(documents)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.sdk.logger.warning(f'HITL: sync of {len(documents)} documents failed: {e!r}')
+                    updated = False
+
+            now = datetime.datetime.utcnow()
+            for document in self.documents.values():
+                document.autocomplete_by_deadline(now)
+            self._resolve()
+
+            interval = self.policy.initial if updated else self.policy.backoff(interval)
@@ -0,0 +1,110 @@
+import datetime
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
+
+from .common import Task, Value, images_digest
+
+
+class ResultStore:
+    def get(self, key: str) -> Optional[Value]:
+        raise NotImplementedError()
+
+    def set(self, key: str, value: Value):
+        raise NotImplementedError()
+
+
+class MemoryResultStore(ResultStore):
+    def __init__(self, maxsize: int = 100000, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Tuple[float, Value]]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[Value]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry[0] > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, value: Value):
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class SqliteResultStore(ResultStore):
+    def __init__(self, path: str, maxsize: int = 1000000, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, used_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)')
+
+    def get(self, key: str) -> Optional[Value]:
+        row = self._db.execute('SELECT value, stored_at FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if self.ttl is not None and now - row[1] > self.ttl:
+            self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+            return None
+        self._db.execute('UPDATE results SET used_at = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Value):
+        now = time.time()
+        self._db.execute(
+            'INSERT OR REPLACE INTO results (key, value, stored_at, used_at) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value), now, now),
+        )
+        count, = self._db.execute('SELECT COUNT(*) FROM results').fetchone()
+        if count > self.maxsize:
+            self._db.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used_at LIMIT ?)',
+                (count - self.maxsize,),
+            )
+
+    def close(self):
+        self._db.close()
+
+
+class ResultCache:
+    def __init__(self, store: Optional[ResultStore] = None):
+        self.store = store if store is not None else MemoryResultStore()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(images: List[Union[bytes, str]], field_name: Optional[str], document_type: Optional[str]) -> str:
+        return f'{document_type}:{field_name}:{images_digest(images)}'
+
+    def get(self, key: str) -> Optional[Value]:
+        value = self.store.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: Value):
+        self.store.set(key, value)
+
+    def lookup(self, task: Task, document_type: Optional[str]) -> Tuple[str, bool]:
+        key = self.key(task.images, task.field_name, document_type)
+        value = self.get(key)
+        if value is None:
+            return key, False
+        task.result = value
+        task.state = 'cached'
+        task.completed_at = datetime.datetime.utcnow()
+        return key, True
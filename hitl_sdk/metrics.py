@@ -0,0 +1,181 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Seconds. Spans network round trips up to human answers, which take minutes or hours.
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200,
+)
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+# Every hook is a no-op here, install a collector with set_metrics.
+class Metrics:
+    enabled = False
+
+    def inc(self, name: str, value: float = 1, **labels):
+        pass
+
+    def gauge(self, name: str, delta: float, **labels):
+        pass
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    @contextlib.contextmanager
+    def in_flight(self, name: str, **labels) -> Iterator[None]:
+        self.gauge(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.gauge(name, -1, **labels)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation.
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return math.nan
+
+
+# Keeps every series in memory, read it with snapshot() or export it with format_prometheus.
+class MetricsRegistry(Metrics):
+    enabled = True
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        # Image preparation reports from executor threads.
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def gauge(self, name: str, delta: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def snapshot(self) -> Dict[str, List[dict]]:
+        with self._lock:
+            result = {}
+            for name, series in self.counters.items():
+                result[name] = [dict(labels=dict(key), value=value) for key, value in series.items()]
+            for name, series in self.gauges.items():
+                result[name] = [dict(labels=dict(key), value=value) for key, value in series.items()]
+            for name, series in self.histograms.items():
+                result[name] = [
+                    dict(
+                        labels=dict(key),
+                        count=h.count,
+                        sum=h.sum,
+                        p50=h.quantile(.5),
+                        p99=h.quantile(.99),
+                    )
+                    for key, h in series.items()
+                ]
+            return result
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    if extra is not None:
+        labels = labels + (extra,)
+    if not labels:
+        return ''
+    escaped = (
+        (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_prometheus(registry: MetricsRegistry) -> str:
+    lines = []
+    with registry._lock:
+        for kind, metrics in (('counter', registry.counters), ('gauge', registry.gauges)):
+            for name, series in sorted(metrics.items()):
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in series.items():
+                    lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        for name, series in sorted(registry.histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, h in series.items():
+                cumulative = 0
+                for bound, count in zip(h.buckets + (math.inf,), h.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(key, ("le", _format_value(bound)))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(key)} {_format_value(h.sum)}')
+                lines.append(f'{name}_count{_format_labels(key)} {h.count}')
+    return '\n'.join(lines) + '\n'
+
+
+_metrics: Metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def set_metrics(metrics: Optional[Metrics]) -> Metrics:
+    global _metrics
+    _metrics = metrics if metrics is not None else Metrics()
+    return _metrics
@@ -0,0 +1,91 @@
+import asyncio
+from typing import Any, Optional
+
+import aiohttp
+
+
+class SessionPool:
+    def __init__(
+            self,
+            limit: int = 100,
+            limit_per_host: int = 0,
+            keepalive_timeout: float = 30.,
+            ttl_dns_cache: Optional[int] = 300,
+            verify_ssl: bool = True,
+            timeout: Optional[aiohttp.ClientTimeout] = None,
+            **session_kwargs: Any,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.verify_ssl = verify_ssl
+        self.timeout = timeout
+        self._session_kwargs = session_kwargs
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _make_connector(self) -> aiohttp.TCPConnector:
+        kw = dict(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=self.ttl_dns_cache is not None,
+            ttl_dns_cache=self.ttl_dns_cache,
+        )
+        if not self.verify_ssl:
+            kw['ssl'] = False
+        return aiohttp.TCPConnector(**kw)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Session is bound to the loop it was created on, so a new loop gets a new pool.
+        loop = asyncio.get_event_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._discard()
+            kw = dict(self._session_kwargs)
+            if self.timeout is not None:
+                kw['timeout'] = self.timeout
+            self._session = aiohttp.ClientSession(connector=self._make_connector(), **kw)
+            self._loop = loop
+        return self._session
+
+    def _discard(self):
+        # The session of a previous loop cannot be awaited here. Close it on its own loop if that one
+        # still runs in another thread, otherwise on the current one, the connector skips transports
+        # of a closed loop.
+        session, self._session = self._session, None
+        if session is None or session.closed:
+            return
+        if self._loop is not None and self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), self._loop)
+        else:
+            asyncio.ensure_future(session.close())
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    async def close(self):
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    def close_at_exit(self):
+        # For process-wide pools, nothing awaits close() at interpreter exit. Close the session on its
+        # loop if that loop is idle, otherwise drop its connections synchronously.
+        session, self._session = self._session, None
+        if session is None or session.closed:
+            return
+        if self._loop is not None and not self._loop.is_closed() and not self._loop.is_running():
+            self._loop.run_until_complete(session.close())
+        else:
+            connector = session.connector
+            session.detach()
+            connector.close()
+
+    async def __aenter__(self) -> 'SessionPool':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
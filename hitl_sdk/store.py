@@ -0,0 +1,92 @@
+import contextlib
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Mapping, MutableMapping, Optional, Tuple
+
+from .common import Task
+
+
+class TaskStore(MutableMapping):
+    def __init__(
+            self,
+            tasks: Optional[Mapping[str, Task]] = None,
+            max_completed: Optional[int] = None,
+            completed_ttl: Optional[float] = None,
+    ):
+        self.max_completed = max_completed
+        self.completed_ttl = completed_ttl
+        self._in_flight: Dict[str, Task] = {}
+        # Ordered by completion time, so eviction pops from the front.
+        self._completed: 'OrderedDict[str, Tuple[float, Task]]' = OrderedDict()
+        # Eviction is put off while a wait is running, it returns every task it tracked.
+        self._holds = 0
+        if tasks:
+            self.update(tasks)
+
+    def __getitem__(self, key: str) -> Task:
+        task = self._in_flight.get(key)
+        if task is not None:
+            return task
+        return self._completed[key][1]
+
+    def __setitem__(self, key: str, task: Task):
+        self._in_flight.pop(key, None)
+        self._completed.pop(key, None)
+        if task.completed_at:
+            self._completed[key] = (time.monotonic(), task)
+            self.evict()
+        else:
+            self._in_flight[key] = task
+
+    def __delitem__(self, key: str):
+        if self._in_flight.pop(key, None) is None:
+            del self._completed[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._in_flight or key in self._completed
+
+    def __iter__(self) -> Iterator[str]:
+        yield from list(self._in_flight)
+        yield from list(self._completed)
+
+    def __len__(self) -> int:
+        return len(self._in_flight) + len(self._completed)
+
+    def in_work_count(self) -> int:
+        return len(self._in_flight)
+
+    def in_flight(self) -> Dict[str, Task]:
+        return self._in_flight
+
+    def completed(self) -> List[Task]:
+        return [task for _, task in self._completed.values()]
+
+    def refresh(self, key: str):
+        # Re-file a task that was completed in place.
+        task = self._in_flight.get(key)
+        if task is not None and task.completed_at:
+            self[key] = task
+
+    def reconcile(self):
+        for key in [key for key, task in self._in_flight.items() if task.completed_at]:
+            self.refresh(key)
+
+    @contextlib.contextmanager
+    def hold(self):
+        self._holds += 1
+        try:
+            yield self
+        finally:
+            self._holds -= 1
+            self.evict()
+
+    def evict(self):
+        if self._holds:
+            return
+        if self.completed_ttl is not None:
+            expired_at = time.monotonic() - self.completed_ttl
+            while self._completed and next(iter(self._completed.values()))[0] < expired_at:
+                self._completed.popitem(last=False)
+        if self.max_completed is not None:
+            while len(self._completed) > self.max_completed:
+                self._completed.popitem(last=False)
@@ -0,0 +1,248 @@
+import asyncio
+import datetime
+import json
+import random
+from collections import Counter
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from aiohttp import web
+
+
+class MockServer:
+    # Status of injected errors, None drops the connection instead.
+    error_status: Optional[int] = 503
+
+    def __init__(
+            self,
+            latency: float = 0.,
+            error_rate: float = 0.,
+            completion_delay: float = 0.,
+            host: str = '127.0.0.1',
+            port: int = 0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.completion_delay = completion_delay
+        self.host = host
+        self.port = port
+        self.requests: Counter = Counter()
+        self.bytes_received = 0
+        self.errors = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def _routes(self) -> List[web.RouteDef]:
+        raise NotImplementedError()
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource
+        self.requests[f'{request.method} {route.canonical if route else request.path}'] += 1
+        self.bytes_received += request.content_length or 0
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            if self.error_status is None:
+                request.transport.close()
+            return web.json_response({'error': 'injected'}, status=self.error_status or 503)
+        return await handler(request)
+
+    def _now(self) -> datetime.datetime:
+        return datetime.datetime.utcnow()
+
+    def _is_done(self, created_at: datetime.datetime) -> bool:
+        return (self._now() - created_at).total_seconds() >= self.completion_delay
+
+    async def start(self) -> 'MockServer':
+        app = web.Application(middlewares=[self._middleware], client_max_size=1024 ** 3)
+        app.add_routes(self._routes())
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> 'MockServer':
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class MockHandl(MockServer):
+    # Handl client retries on connection errors only, it reads any response body as a result.
+    error_status = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.projects: Dict[str, Dict[str, Any]] = {}
+        self.items: Dict[str, List[Dict[str, Any]]] = {}
+        self.uploads: Dict[str, int] = {}
+
+    def _routes(self) -> List[web.RouteDef]:
+        return [
+            web.post('/login', self._login),
+            web.get('/projects', self._list_projects),
+            web.post('/projects', self._create_project),
+            web.get('/projects/{id}', self._get_project),
+            web.put('/projects/{id}/state', self._set_state),
+            web.get('/projects/{id}/url', self._presign),
+            web.put('/upload/{name}', self._upload),
+            web.post('/projects/{id}/dataset', self._dataset),
+            web.get('/projects/{id}/result', self._result),
+        ]
+
+    async def _login(self, request: web.Request) -> web.Response:
+        return web.json_response({'token': uuid4().hex})
+
+    async def _list_projects(self, request: web.Request) -> web.Response:
+        return web.json_response(list(self.projects.values()))
+
+    async def _create_project(self, request: web.Request) -> web.Response:
+        project = await request.json()
+        project.update(id=uuid4().hex, state='draft')
+        self.projects[project['id']] = project
+        self.items[project['id']] = []
+        return web.json_response(project)
+
+    async def _get_project(self, request: web.Request) -> web.Response:
+        return web.json_response(self.projects[request.match_info['id']])
+
+    async def _set_state(self, request: web.Request) -> web.Response:
+        project = self.projects[request.match_info['id']]
+        project['state'] = await request.json()
+        return web.json_response(project)
+
+    async def _presign(self, request: web.Request) -> web.Response:
+        name = request.query['file']
+        return web.json_response({'uri': f'{self.url}/upload/{name}', 'image': name})
+
+    async def _upload(self, request: web.Request) -> web.Response:
+        self.uploads[request.match_info['name']] = len(await request.read())
+        return web.Response()
+
+    async def _dataset(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if isinstance(data, dict):
+            data = [data]
+        created = []
+        for item in data:
+            item = dict(item, id=uuid4().hex, created_at=self._now())
+            self.items[request.match_info['id']].append(item)
+            created.append({'id': item['id'], 'image': item.get('image')})
+        return web.json_response(created)
+
+    async def _result(self, request: web.Request) -> web.Response:
+        offset = int(request.query.get('offset', 0))
+        results = []
+        for item in self.items[request.match_info['id']]:
+            # Results are appended in completion order, creation order is the same with a fixed delay.
+            if not self._is_done(item['created_at']):
+                break
+            text = item.get('text') or ''
+            try:
+                labels = json.loads(text)
+            except ValueError:
+                labels = {}
+            results.append({
+                'id': item['id'],
+                'payload': {
+                    'text': text or 'human',
+                    'aabb': labels if isinstance(labels, dict) else {},
+                    'ocrs': {},
+                },
+            })
+        return web.json_response(results[offset:])
+
+
+class MockToloka(MockServer):
+    fields_per_document = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tasks: Dict[str, Dict[str, Any]] = {}
+        self.documents: Dict[str, Dict[str, Any]] = {}
+
+    def _routes(self) -> List[web.RouteDef]:
+        return [
+            web.post('/tasks', self._create_tasks),
+            web.get('/tasks', self._get_tasks),
+            web.post('/document', self._create_document),
+            web.get('/document', self._get_document),
+        ]
+
+    def _new_task(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        task = {
+            'id': uuid4().hex,
+            'state': 'in_work',
+            'field_name': item.get('field_name'),
+            'document_type': item.get('document_type'),
+            'document_id': item.get('document_id'),
+            'predict': item.get('predict'),
+            'deadline_at': item.get('deadline_at'),
+            'created_at': self._now(),
+        }
+        self.tasks[task['id']] = task
+        return task
+
+    def _task_view(self, task: Dict[str, Any]) -> Dict[str, Any]:
+        view = dict(task, created_at=task['created_at'].isoformat())
+        if self._is_done(task['created_at']):
+            view.update(
+                state='completed',
+                result=task['predict'] or 'human',
+                completed_at=(task['created_at'] + datetime.timedelta(seconds=self.completion_delay)).isoformat(),
+            )
+        return view
+
+    async def _create_tasks(self, request: web.Request) -> web.Response:
+        items = await request.json()
+        return web.json_response([self._task_view(self._new_task(item)) for item in items])
+
+    async def _get_tasks(self, request: web.Request) -> web.Response:
+        ids = (await request.json())['ids']
+        return web.json_response([self._task_view(self.tasks[i]) for i in ids if i in self.tasks])
+
+    async def _create_document(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        tasks = [
+            self._new_task(dict(payload, field_name=f'field_{i}'))
+            for i in range(self.fields_per_document)
+        ]
+        document = {
+            'id': uuid4().hex,
+            'document_type': payload.get('document_type'),
+            'document_id': payload.get('document_id'),
+            'task_ids': [task['id'] for task in tasks],
+            'created_at': self._now(),
+        }
+        self.documents[document['id']] = document
+        return web.json_response(self._document_view(document))
+
+    def _document_view(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        tasks = [self._task_view(self.tasks[i]) for i in document['task_ids']]
+        view = {
+            'id': document['id'],
+            'document_type': document['document_type'],
+            'document_id': document['document_id'],
+            'state': 'in_work',
+            'created_at': document['created_at'].isoformat(),
+            'tasks': tasks,
+        }
+        if all(task.get('completed_at') for task in tasks):
+            view.update(state='completed', completed_at=max(task['completed_at'] for task in tasks))
+        return view
+
+    async def _get_document(self, request: web.Request) -> web.Response:
+        return web.json_response(self._document_view(self.documents[request.query['id']]))
@@ -0,0 +1,67 @@
+import asyncio
+import dataclasses
+from typing import Dict, List, Optional
+
+from ..common import PollingPolicy, Task
+from ..manager import DocumentManager
+from ..store import TaskStore
+from .sdk import SDK
+
+
+class TolokaDocumentManager(DocumentManager):
+    def __init__(self, sdk: SDK, policy: Optional[PollingPolicy] = None):
+        # Tracked tasks are polled and dropped here, keep them apart from the caller's sdk.tasks.
+        # The copy shares the connection pool and the result cache.
+        tasks = TaskStore(max_completed=sdk.tasks.max_completed, completed_ttl=sdk.tasks.completed_ttl)
+        sdk = dataclasses.replace(sdk, tasks=tasks, document=None)
+        super().__init__(sdk, policy)
+        # Task keys in sdk.tasks of every tracked document.
+        self._document_tasks: Dict[str, List[str]] = {}
+
+    def track(self, document: Task):
+        super().track(document)
+        if document.id in self.documents and document.tasks:
+            self._document_tasks[document.id] = [self.sdk._store(task) for task in document.tasks]
+
+    def _update(self, document: Task):
+        super()._update(document)
+        if not document.completed_at:
+            self.track(document)
+
+    def _forget(self, document: Task):
+        for key in self._document_tasks.pop(document.id, []):
+            self.sdk.tasks.pop(key, None)
+
+    def _tasks_done(self, document: Task) -> bool:
+        # Evicted tasks were completed.
+        tasks = (self.sdk.tasks.get(key) for key in self._document_tasks[document.id])
+        return all(task is None or task.completed_at for task in tasks)
+
+    async def _poll(self, documents: List[Task]) -> bool:
+        # Tasks of every document are asked in one batched GET tasks, a document itself is fetched
+        # once all its tasks are completed, or on every poll while its tasks are unknown.
+        updated = False
+        if any(document.id in self._document_tasks for document in documents):
+            updated = await self.sdk.sync_tasks()
+
+        fetch = [
+            document
+            for document in documents
+            if document.id not in self._document_tasks or self._tasks_done(document)
+        ]
+        semaphore = asyncio.Semaphore(self.sdk.max_concurrency)
+
+        async def fetch_document(document: Task) -> Task:
+            async with semaphore:
+                return await self.sdk.fetch_document(document.id)
+
+        results = await asyncio.gather(*(fetch_document(d) for d in fetch), return_exceptions=True)
+        for document, result in zip(fetch, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, BaseException):
+                self.sdk.logger.warning(f'HITL: sync of document {document.id} failed: {result!r}')
+                continue
+            updated = updated or result.state != document.state or bool(result.completed_at)
+            self._update(result)
+        return updated
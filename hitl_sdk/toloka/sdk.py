@@ -1,15 +1,52 @@
 import asyncio
-import base64
+import atexit
 import datetime
+import itertools
+import json
 import os
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from logging import getLogger, Logger
-from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union, Any
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple, Union, Any
+from uuid import uuid4
 
 import aiohttp
 
-from ..common import default_retry_strategy, Task, DocumentStruct
+from ..common import (default_retry_strategy, Task, DocumentStruct, PollingPolicy, observe_task_wait,
+                      wait_for_completion)
 from ..env import SUGGESTIONS_GATEWAY
+from ..memo import ResultCache
+from .. import tracing
+from ..metrics import Metrics, get_metrics
+from ..store import TaskStore
+from ..session import SessionPool
+from .stream import json_stream
+
+
+async def _count_sent(chunks: AsyncIterator[bytes], metrics: Metrics, labels: Dict[str, str]) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        metrics.inc('hitl_request_sent_bytes_total', len(chunk), **labels)
+        yield chunk
+
+
+# One pool per process for every SDK with the same settings, SDK(private_pool=True) gets its own.
+_pools: Dict[Tuple[int, float, Optional[float], Optional[float]], SessionPool] = {}
+
+
+def _make_pool(
+        pool_size: int,
+        keepalive_timeout: float,
+        request_timeout: Optional[float],
+        connect_timeout: Optional[float],
+) -> SessionPool:
+    return SessionPool(
+        limit=pool_size,
+        keepalive_timeout=keepalive_timeout,
+        verify_ssl=False,
+        timeout=aiohttp.ClientTimeout(
+            total=request_timeout,
+            connect=connect_timeout,
+        ),
+    )
 
 
 @dataclass
@@ -18,12 +55,62 @@ class SDK:
     token: Optional[str] = None
     license_id: Optional[str] = None
     system_info_token: Optional[str] = None
-    tasks: Dict[str, Task] = field(default_factory=dict)
+    tasks: TaskStore = field(default_factory=TaskStore)
     document: Optional[Task] = None
     request_retry_strategy: Optional[Iterable] = default_retry_strategy()
     suggestions_gateway: Optional[str] = SUGGESTIONS_GATEWAY
     logger: Logger = getLogger('hitl-sdk')
     confidence_threshold: Optional[Any] = None
+    polling_policy: Optional[PollingPolicy] = None
+    # SDK instances share a process-wide pool unless one is passed or private_pool is set;
+    # only a private pool is closed by SDK.close().
+    pool: Optional[SessionPool] = None
+    private_pool: bool = False
+    pool_size: int = 100
+    keepalive_timeout: float = 30.
+    # Same as the aiohttp default, None disables the limit.
+    request_timeout: Optional[float] = 300.
+    connect_timeout: Optional[float] = None
+    result_cache: Optional[ResultCache] = None
+    # Drop image payloads from tracked tasks, only Task.image_hash is kept.
+    release_payloads: bool = True
+    # create_tasks and sync_tasks split work into chunks and send up to max_concurrency of them at once.
+    chunk_max_items: int = 100
+    chunk_max_bytes: int = 32 * 1024 * 1024
+    max_concurrency: int = 4
+    # sync_tasks asks for at most sync_chunk_size ids per request.
+    sync_chunk_size: int = 200
+    # Set when the backend honours `updated_since` on GET tasks.
+    updated_since_supported: bool = False
+    _synced_at: Optional[datetime.datetime] = field(default=None, init=False, repr=False)
+    _memo_keys: Dict[str, str] = field(default_factory=dict, init=False, repr=False)
+    # Span of the last create_tasks/create_document call, waiting for its results is traced under it.
+    _trace: Optional[tracing.Span] = field(default=None, init=False, repr=False)
+    _own_pool: bool = field(default=False, init=False, repr=False)
+
+    def __post_init__(self):
+        if not isinstance(self.tasks, TaskStore):
+            self.tasks = TaskStore(self.tasks)
+        if self.pool is None:
+            settings = (self.pool_size, self.keepalive_timeout, self.request_timeout, self.connect_timeout)
+            if self.private_pool:
+                self.pool = _make_pool(*settings)
+                self._own_pool = True
+            else:
+                if settings not in _pools:
+                    _pools[settings] = _make_pool(*settings)
+                    atexit.register(_pools[settings].close_at_exit)
+                self.pool = _pools[settings]
+
+    async def close(self):
+        if self._own_pool:
+            await self.pool.close()
+
+    async def __aenter__(self) -> 'SDK':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
     @staticmethod
     def _get_task_key(task: Task) -> str:
@@ -39,7 +126,8 @@ class SDK:
                        params: Optional[dict] = None,
                        data: Optional[Union[dict, list]] = None,
                        endpoint: str = 'tasks',
-                       retry_times: Iterator = None) -> List[dict]:
+                       retry_times: Iterator = None,
+                       stream: bool = False) -> List[dict]:
         headers = {
             'Content-Type': 'application/json',
         }
@@ -56,19 +144,7 @@ class SDK:
 
         self.logger.debug(f'HITL SDK request: {method} {endpoint} params={params}')
         try:
-            async with aiohttp.ClientSession(
-                    connector=aiohttp.TCPConnector(verify_ssl=False),
-                    raise_for_status=True,
-            ) as session:
-                async with session.request(
-                        method=method,
-                        url=os.path.join(self.host, endpoint),
-                        headers=headers,
-                        params=params,
-                        json=data,
-                ) as resp:
-                    resp.raise_for_status()
-                    return await resp.json()
+            return await self._send(method, endpoint, headers, params, data, stream)
         except Exception as e:
             if retry_times is None:
                 if isinstance(self.request_retry_strategy, Iterable):
@@ -77,6 +153,7 @@ class SDK:
                     retry_times = iter([])
 
             for i in retry_times:
+                get_metrics().inc('hitl_request_retries_total', backend='toloka', method=method, endpoint=endpoint)
                 self.logger.warning(f"Request to hitl wasn't successfull. Wait {i} seconds to retry...")
                 await asyncio.sleep(i)
                 return await self._request(
@@ -84,11 +161,49 @@ class SDK:
                     params=params,
                     data=data,
                     endpoint=endpoint,
-                    retry_times=retry_times)
+                    retry_times=retry_times,
+                    stream=stream)
 
             self.logger.error(f"Error with hitl: {e}")
             raise e
 
+    async def _send(self,
+                    method: str,
+                    endpoint: str,
+                    headers: Dict[str, str],
+                    params: dict,
+                    data: Optional[Union[dict, list]],
+                    stream: bool) -> List[dict]:
+        metrics = get_metrics()
+        labels = dict(backend='toloka', method=method, endpoint=endpoint)
+        body = None
+        if stream:
+            body = json_stream(data)
+            if metrics.enabled:
+                body = _count_sent(body, metrics, labels)
+        elif data is not None and metrics.enabled:
+            metrics.inc('hitl_request_sent_bytes_total', len(json.dumps(data)), **labels)
+
+        status = 'error'
+        try:
+            with metrics.in_flight('hitl_requests_in_flight', **labels), \
+                    metrics.timer('hitl_request_seconds', **labels):
+                async with self.pool.session.request(
+                        method=method,
+                        url=os.path.join(self.host, endpoint),
+                        headers=headers,
+                        params=params,
+                        json=None if stream else data,
+                        data=body,
+                ) as resp:
+                    status = str(resp.status)
+                    resp.raise_for_status()
+                    metrics.inc('hitl_request_received_bytes_total', len(await resp.read()), **labels)
+                    return await resp.json()
+        finally:
+            metrics.inc('hitl_requests_total', status=status, **labels)
+
+    @tracing.traced('create_tasks', 'document_type', 'document_id')
     async def create_tasks(
             self,
             tasks: List[Task],
@@ -98,25 +213,33 @@ class SDK:
             mock: bool = False,
             processing_type: Optional[str] = None,
             document_structure: DocumentStruct = None,
+            only_created: bool = False,
     ) -> List[Task]:
+        self._trace = tracing.current_span()
+        tasks = [task for task in tasks if task.images]
+
+        created = []
+        memo_keys = []
+        if self.result_cache is not None:
+            sent = []
+            for task in tasks:
+                key, hit = self.result_cache.lookup(task, document_type)
+                if hit:
+                    task.id = task.id or str(uuid4())
+                    self._store(task)
+                    created.append(task)
+                else:
+                    sent.append(task)
+                    memo_keys.append(key)
+            if not sent:
+                return created if only_created else list(self.tasks.values())
+            tasks = sent
+
         body = [
             {
-                'images': [
-                    base64.b64encode(
-                        image,
-                    ).decode()
-                    if isinstance(image, bytes) else
-                    image
-                    for image in task.images
-                ],
-                'uncut_images': [
-                    base64.b64encode(
-                        image,
-                    ).decode()
-                    if isinstance(image, bytes) else
-                    image
-                    for image in task.uncut_images
-                ],
+                # bytes are base64-encoded while the body is streamed
+                'images': task.images,
+                'uncut_images': task.uncut_images,
                 'predict': task.predict,
                 'predict_confidence': task.predict_confidence,
                 'type': task_type,
@@ -131,7 +254,6 @@ class SDK:
 
             }
             for task in tasks
-            if task.images
         ]
         if not body:
             return []
@@ -146,18 +268,101 @@ class SDK:
         if processing_type:
             params['processing_type'] = processing_type
 
-        resp = await self._request(
-            method='POST',
-            data=body,
-            params=params,
+        chunks = self._chunk_body(body)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def send(start: int, end: int) -> List[dict]:
+            async with semaphore:
+                with tracing.span('register_tasks', items=end - start):
+                    return await self._request(
+                        method='POST',
+                        data=body[start:end],
+                        params=dict(params),
+                        stream=True,
+                    )
+
+        # Every chunk retries on its own, a failed chunk does not resend the others.
+        results = await asyncio.gather(
+            *(send(start, end) for start, end in chunks),
+            return_exceptions=True,
         )
 
-        for item in resp:
-            task = Task.from_dict(item)
-            self.tasks[self._get_task_key(task)] = task
-
+        errors = []
+        for (start, end), resp in zip(chunks, results):
+            if isinstance(resp, asyncio.CancelledError):
+                raise resp
+            if isinstance(resp, BaseException):
+                errors.append(resp)
+                continue
+
+            keys = self._match_memo_keys(body[start:end], memo_keys[start:end], resp)
+            for item, memo_key in zip(resp, keys):
+                task = Task.from_dict(item)
+                key = self._store(task)
+                created.append(task)
+                if memo_key is not None:
+                    self._memo_keys[key] = memo_key
+                    if task.completed_at:
+                        self._memoize(key, task)
+
+        if errors:
+            raise errors[0]
+
+        if only_created:
+            return created
         return list(self.tasks.values())
 
+    @staticmethod
+    def _match_memo_keys(sent: List[dict], memo_keys: List[str], resp: List[dict]) -> List[Optional[str]]:
+        # A cached answer is served for every later identical crop, so a response item gets a key only
+        # when it surely belongs to that crop: by a unique field_name, or by position if the server
+        # returned exactly the sent fields in the same order.
+        if not memo_keys:
+            return [None] * len(resp)
+        by_field: Dict[Optional[str], List[str]] = {}
+        for item, key in zip(sent, memo_keys):
+            by_field.setdefault(item['field_name'], []).append(key)
+        if all(name is not None and len(keys) == 1 for name, keys in by_field.items()):
+            return [by_field.get(item.get('field_name'), [None])[0] for item in resp]
+        if [item.get('field_name') for item in resp] == [item['field_name'] for item in sent]:
+            return list(memo_keys)
+        return [None] * len(resp)
+
+    def _chunk_body(self, body: List[dict]) -> List[Tuple[int, int]]:
+        chunks = []
+        start = size = 0
+        for end, item in enumerate(body):
+            item_size = self._estimate_size(item)
+            if end > start and (end - start >= self.chunk_max_items or size + item_size > self.chunk_max_bytes):
+                chunks.append((start, end))
+                start, size = end, 0
+            size += item_size
+        chunks.append((start, len(body)))
+        return chunks
+
+    @staticmethod
+    def _estimate_size(item: dict) -> int:
+        size = 1024
+        for image in itertools.chain(item['images'], item['uncut_images']):
+            size += (len(image) + 2) // 3 * 4 if isinstance(image, bytes) else len(image)
+        return size
+
+    def _store(self, task: Task) -> str:
+        if self.release_payloads:
+            task.release_payload()
+        key = self._get_task_key(task)
+        self.tasks[key] = task
+        return key
+
+    def _forget_memo(self, task: Task):
+        self._memo_keys.pop(self._get_task_key(task), None)
+
+    def _memoize(self, key: str, task: Task):
+        memo_key = self._memo_keys.pop(key, None)
+        if memo_key is not None and self.result_cache is not None and not task.is_timeout():
+            self.result_cache.set(memo_key, task.result)
+
+    @tracing.traced('create_document', 'document_type', 'document_id')
     async def create_document(
             self,
             images: List[Union[bytes, str]],
@@ -170,16 +375,35 @@ class SDK:
             processing_type: Optional[str] = None,
             deadline_at: datetime.datetime = None,
     ) -> Optional[Task]:
+        self._trace = tracing.current_span()
+        self.document = await self.submit_document(
+            images,
+            document_type=document_type,
+            document_id=document_id,
+            only_classify=only_classify,
+            only_ocr=only_ocr,
+            integrity_check=integrity_check,
+            mock=mock,
+            processing_type=processing_type,
+            deadline_at=deadline_at,
+        )
+        return self.document
+
+    async def submit_document(
+            self,
+            images: List[Union[bytes, str]],
+            document_type: Optional[str] = None,
+            document_id: Optional[str] = None,
+            only_classify: bool = False,
+            only_ocr: bool = False,
+            integrity_check: bool = False,
+            mock: bool = False,
+            processing_type: Optional[str] = None,
+            deadline_at: datetime.datetime = None,
+    ) -> Optional[Task]:
+        # Same as create_document, but the document is not the one this SDK waits for.
         payload = {
-            'images': [
-                base64.b64encode(
-                    image,
-                ).decode()
-                if isinstance(image, bytes)
-                else
-                image
-                for image in images
-            ],
+            'images': images,
             'document_type': document_type,
             'document_id': document_id,
             'suggestions_gateway': self.suggestions_gateway,
@@ -206,105 +430,126 @@ class SDK:
             endpoint='document',
             data=payload,
             params=params,
+            stream=True,
         )
 
-        self.document = Task.from_dict(resp)
-
-        return self.document
+        document = Task.from_dict(resp)
+        if self.release_payloads:
+            document.release_payload()
+        return document
 
     async def ocr_multiple(self, *_, **__):
         raise NotImplementedError()
 
-    async def sync_document(self):
-        try:
-            resp = await self._request(
-                method='GET',
-                endpoint='document',
-                params={
-                    'id': self.document.id,
-                }
-            )
+    async def fetch_document(self, document_id: str) -> Task:
+        resp = await self._request(
+            method='GET',
+            endpoint='document',
+            params={
+                'id': document_id,
+            }
+        )
+
+        document = Task.from_dict(resp)
+        if self.release_payloads:
+            document.release_payload()
+        return document
 
-            self.document = Task.from_dict(resp)
+    async def sync_document(self) -> bool:
+        try:
+            state = self.document.state
+            self.document = await self.fetch_document(self.document.id)
+            if self.document.completed_at:
+                observe_task_wait(self.document, 'toloka')
 
             for task in self.document.tasks:
-                task = Task.from_dict(task)
-                self.tasks[self._get_task_key(task)] = task
+                self._store(Task.from_dict(task))
+            return self.document.state != state or bool(self.document.completed_at)
         except Exception as e:
-            print(e)
+            self.logger.warning(f'HITL: sync failed: {e!r}')
+            return False
 
     async def sync_tasks(self) -> bool:
-        tasks_ids = set(
-            _id.split(':')[0]
-            for _id in filter(
-                lambda x: (
-                        not self.tasks.get(x)
-                        or
-                        not self.tasks[x].completed_at
-                ),
-                self.tasks.keys(),
-            )
-        )
+        tasks_ids = list(dict.fromkeys(task.id for task in self.tasks.in_flight().values()))
+        if not tasks_ids:
+            return False
 
-        has_updates = False
+        params = {}
+        if self.updated_since_supported and self._synced_at is not None:
+            params['updated_since'] = self._synced_at.isoformat()
+        synced_at = datetime.datetime.utcnow()
 
-        if not tasks_ids:
-            return has_updates
+        semaphore = asyncio.Semaphore(self.max_concurrency)
 
-        try:
-            tasks = await self._request(
-                method='GET',
-                data={
-                    'ids': list(tasks_ids),
-                },
-            )
+        async def fetch(ids: List[str]) -> List[dict]:
+            async with semaphore:
+                return await self._request(
+                    method='GET',
+                    data={
+                        'ids': ids,
+                    },
+                    params=dict(params),
+                )
+
+        size = self.sync_chunk_size
+        results = await asyncio.gather(
+            *(fetch(tasks_ids[i:i + size]) for i in range(0, len(tasks_ids), size)),
+            return_exceptions=True,
+        )
+
+        has_updates = False
+        failed = False
+        for tasks in results:
+            if isinstance(tasks, asyncio.CancelledError):
+                raise tasks
+            if isinstance(tasks, BaseException):
+                # Ids of a failed chunk stay in flight and are asked again on the next poll.
+                self.logger.warning(f'HITL: sync failed: {tasks!r}')
+                failed = True
+                continue
 
             for task in tasks:
                 task = Task.from_dict(task)
-                self.tasks[self._get_task_key(task)] = task
+                key = self._store(task)
                 if task.completed_at:
+                    observe_task_wait(task, 'toloka')
+                    self._memoize(key, task)
                     has_updates = True
-        except Exception as e:
-            print(e)
 
+        if not failed:
+            self._synced_at = synced_at
         return has_updates
 
     def in_work_count(self) -> Tuple[int, int]:
         return (
-            sum(
-                1
-                for v in self.tasks.values()
-                if not v.completed_at
-            ),
+            self.tasks.in_work_count(),
             int(bool(
                 self.document and not self.document.completed_at
             )),
         )
 
-    async def wait_until_complete(self, timeout: float = 5.) -> List[Task]:
-        while True:
-            in_work = self.in_work_count()
-            if not sum(in_work):
-                break
-
-            await asyncio.sleep(timeout)
-
-            if in_work[1]:
-                print(f'HITL: In work {in_work[1]} document. Sync...')
-                await self.sync_document()
-            else:
-                print(f'HITL: In work {in_work[0]} tasks. Sync...')
-                await self.sync_tasks()
-        return list(self.tasks.values())
+    async def wait_until_complete(
+            self,
+            timeout: float = 5.,
+            max_wait: Optional[float] = None,
+            policy: Optional[PollingPolicy] = None,
+    ) -> List[Task]:
+        policy = policy or self.polling_policy or PollingPolicy(initial=timeout)
+        if max_wait is not None:
+            policy = replace(policy, max_wait=max_wait)
+        with self.tasks.hold(), tracing.span('wait_until_complete', parent=self._trace):
+            await wait_for_completion(self, policy)
+            return list(self.tasks.values())
 
     async def create_and_wait(
             self,
             tasks: List[Task], document_type: Optional[str] = None,
             timeout: float = 5., **kwargs
     ) -> List[Task]:
-        await self.create_tasks(
-            tasks=tasks,
-            document_type=document_type,
-            **kwargs,
-        )
-        return await self.wait_until_complete(timeout=timeout)
+        with self.tasks.hold():
+            await self.create_tasks(
+                tasks=tasks,
+                document_type=document_type,
+                **kwargs,
+            )
+            return await self.wait_until_complete(timeout=timeout)
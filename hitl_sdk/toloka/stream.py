@@ -0,0 +1,51 @@
+import base64
+import json
+from typing import Any, AsyncIterator, Iterator
+
+# Multiple of 3, so every chunk encodes to base64 without padding in the middle of a string.
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+WRITE_SIZE = 256 * 1024
+
+
+def iter_base64(data: bytes) -> Iterator[bytes]:
+    view = memoryview(data)
+    for start in range(0, len(view), BASE64_CHUNK_SIZE):
+        yield base64.b64encode(view[start:start + BASE64_CHUNK_SIZE])
+
+
+def iter_json(value: Any) -> Iterator[bytes]:
+    # Same as json.dumps, but bytes are written as base64 strings chunk by chunk.
+    if isinstance(value, (bytes, bytearray)):
+        yield b'"'
+        yield from iter_base64(value)
+        yield b'"'
+    elif isinstance(value, dict):
+        yield b'{'
+        for n, (key, item) in enumerate(value.items()):
+            if n:
+                yield b','
+            yield json.dumps(str(key)).encode()
+            yield b':'
+            yield from iter_json(item)
+        yield b'}'
+    elif isinstance(value, (list, tuple)):
+        yield b'['
+        for n, item in enumerate(value):
+            if n:
+                yield b','
+            yield from iter_json(item)
+        yield b']'
+    else:
+        yield json.dumps(value).encode()
+
+
+async def json_stream(value: Any, write_size: int = WRITE_SIZE) -> AsyncIterator[bytes]:
+    buf = bytearray()
+    for chunk in iter_json(value):
+        buf += chunk
+        if len(buf) >= write_size:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
+
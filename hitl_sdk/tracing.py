@@ -0,0 +1,158 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, IO, Optional
+
+# Copied from a parent span to its children, so every span of a document can be found by these tags.
+INHERITED_TAGS = ('document_id', 'document_type', 'field_name')
+
+_current: 'contextvars.ContextVar[Optional[Span]]' = contextvars.ContextVar('hitl_span', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'tags', 'started_at', 'duration', 'error',
+                 '_started', '_token', '_tracer')
+
+    def __init__(self, tracer: 'Tracer', name: str, parent: Optional['Span'], tags: Dict[str, Any]):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        if parent is None:
+            self.trace_id = os.urandom(16).hex()
+            self.parent_id = None
+            self.tags = tags
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.tags = {key: parent.tags[key] for key in INHERITED_TAGS if key in parent.tags}
+            self.tags.update(tags)
+        self.started_at = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+        self._token = None
+        self._tracer = tracer
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def __enter__(self) -> 'Span':
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._started
+        if exc is not None:
+            self.error = repr(exc)
+        _current.reset(self._token)
+        self._tracer.export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'tags': self.tags,
+            'error': self.error,
+        }
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def tag(self, **tags):
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+# Disabled tracer, span() hands out one shared no-op object. Install a recording one with set_tracer.
+class Tracer:
+    enabled = False
+
+    def span(self, name: str, parent: Optional[Span] = None, **tags):
+        return _NOOP_SPAN
+
+    def export(self, span: Span):
+        pass
+
+
+class RecordingTracer(Tracer):
+    enabled = True
+
+    def __init__(self, exporter: Callable[[Span], None]):
+        self.exporter = exporter
+
+    def span(self, name: str, parent: Optional[Span] = None, **tags) -> Span:
+        if not isinstance(parent, Span):
+            parent = _current.get()
+        return Span(self, name, parent, tags)
+
+    def export(self, span: Span):
+        self.exporter(span)
+
+
+def json_lines_exporter(stream: IO[str]) -> Callable[[Span], None]:
+    lock = threading.Lock()
+
+    def export(span: Span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with lock:
+            stream.write(line)
+            stream.flush()
+    return export
+
+
+_tracer: Tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def set_tracer(tracer: Optional[Tracer]) -> Tracer:
+    global _tracer
+    _tracer = tracer if tracer is not None else Tracer()
+    return _tracer
+
+
+def span(name: str, parent: Optional[Span] = None, **tags):
+    return _tracer.span(name, parent, **tags)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def traced(name: str, *tag_names: str):
+    # Wraps a coroutine method in a span tagged with the named arguments that are set.
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not _tracer.enabled:
+                return await func(*args, **kwargs)
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            tags = {
+                key: arguments[key]
+                for key in tag_names
+                if arguments.get(key) is not None
+            }
+            with _tracer.span(name, **tags):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import time
 
 from hitl_sdk.toloka.sdk import SDK as HitlSDK, Task
 
@@ -14,3 +15,731 @@ def test_retry():
         except Exception as e:
             assert f"{e}" == "Cannot connect to host localhost:8888 ssl:None [Connect call failed ('127.0.0.1', 8888)]"
     asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_session_pool_reuse():
+    from hitl_sdk.session import SessionPool
+
+    pool = SessionPool()
+
+    async def _test():
+        session = pool.session
+        assert pool.session is session
+        await pool.close()
+        assert pool.closed
+        assert pool.session is not session
+        await pool.close()
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_sdk_shares_pool():
+    async def _test():
+        sdk = HitlSDK(host='http://localhost:8888')
+        assert HitlSDK(host='http://localhost:8888').pool is sdk.pool
+        assert HitlSDK(host='http://localhost:8888', request_timeout=10.).pool is not sdk.pool
+        async with HitlSDK(host='http://localhost:8888', private_pool=True) as private:
+            assert private.pool is not sdk.pool
+            session = private.pool.session
+        assert session.closed
+        await sdk.close()
+        assert sdk.pool.session is not None and not sdk.pool.closed
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_session_pool_new_loop():
+    from hitl_sdk.session import SessionPool
+
+    pool = SessionPool()
+    default = asyncio.get_event_loop()
+    loops = [asyncio.new_event_loop(), asyncio.new_event_loop()]
+
+    async def session():
+        return pool.session
+
+    try:
+        asyncio.set_event_loop(loops[0])
+        old = loops[0].run_until_complete(session())
+        loops[0].close()
+
+        asyncio.set_event_loop(loops[1])
+        new = loops[1].run_until_complete(session())
+        loops[1].run_until_complete(asyncio.sleep(0))
+        assert new is not old and old.closed and not new.closed
+        loops[1].run_until_complete(pool.close())
+    finally:
+        loops[1].close()
+        asyncio.set_event_loop(default)
+
+
+def test_result_poller_shares_requests():
+    from hitl_sdk.handl.api import Handl
+
+    handl = Handl(url='http://localhost:8888', username='', password='')
+    handl.poll_interval = 0.01
+    calls = []
+
+    async def get_results(project_id):
+        calls.append(project_id)
+        return [{'id': str(i), 'payload': {'text': str(i)}} for i in range(len(calls) * 50)]
+    handl.get_results = get_results
+
+    async def _test():
+        results = await asyncio.gather(*(handl.wait_result('pid', str(i)) for i in range(100)))
+        assert [r['payload']['text'] for r in results] == [str(i) for i in range(100)]
+        assert len(calls) == 2
+        assert await handl.get_result('pid', '99') == '99'
+        assert len(calls) == 2
+        assert await handl.get_result('pid', '120') == '120'
+        assert len(calls) == 3
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_result_poller_skips_seen_results():
+    from hitl_sdk.handl.api import Handl
+    from hitl_sdk.handl.poller import ResultPoller
+
+    handl = Handl(url='http://localhost:8888', username='', password='')
+    responses = [['a', 'b'], ['x', 'a', 'b', 'c'], ['x', 'a', 'b', 'c', 'd'], ['x', 'a', 'b', 'c', 'd']]
+
+    async def get_results(project_id):
+        return [{'id': i} for i in responses.pop(0)]
+    handl.get_results = get_results
+
+    poller = ResultPoller(handl, 'pid')
+    skip_seen = poller._skip_seen
+    seen = []
+
+    def record(results):
+        new = skip_seen(results)
+        seen.append([result['id'] for result in new])
+        return new
+    poller._skip_seen = record
+
+    async def _test():
+        for _ in range(4):
+            await poller.refresh(max_age=0)
+        assert seen == [['a', 'b'], ['x', 'c'], ['d'], []]
+        assert (poller._cursor, poller._last_id, len(poller.index)) == (5, 'd', 5)
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_result_poller_drops_idle_projects():
+    from hitl_sdk.handl import sdk as handl_sdk
+    from hitl_sdk.handl.api import Handl
+
+    handl = Handl(url='http://localhost:8888', username='', password='')
+    handl.poll_interval = 0.01
+    handl.results_offset_supported = True
+    offsets = []
+
+    async def get_results(project_id, offset=None):
+        if project_id != 'ocr':
+            return [{'id': project_id, 'payload': {'text': project_id}}]
+        offsets.append(offset)
+        return [{'id': str(i), 'payload': {'text': str(i)}} for i in range(5)][offset or 0:]
+    handl.get_results = get_results
+
+    async def get_or_create_project(*args, **kwargs):
+        return {'id': 'ocr'}
+    handl.get_or_create_project = get_or_create_project
+
+    async def _test():
+        sdk = handl_sdk.SDK()
+        sdk.tasks['task'] = Task(id='task')
+        for i in range(10):
+            # The ocr project is only refreshed, never waited on, and has to keep its index.
+            await sdk.sync_tasks()
+            assert (await handl.wait_result(str(i), str(i)))['payload']['text'] == str(i)
+            await asyncio.sleep(0.03)
+        assert offsets == [0] + [5] * 9
+        assert 'ocr' in handl._pollers and len(handl._pollers['ocr'].index) == 5
+        assert len(handl._pollers) < 8 and '0' not in handl._pollers
+
+    handl_sdk.set_handl(handl)
+    try:
+        asyncio.get_event_loop().run_until_complete(_test())
+    finally:
+        handl_sdk.set_handl(None)
+
+
+def test_wait_until_complete_budget():
+    from hitl_sdk.common import PollingPolicy
+
+    sdk = HitlSDK(host='http://localhost:8888')
+    sdk.tasks['1'] = Task(id='1', predict='a')
+    sdk.tasks['2'] = Task(id='2', predict='b')
+    sdk._memo_keys.update({'1': 'memo1', '2': 'memo2'})
+    syncs = []
+
+    async def sync_tasks():
+        syncs.append(1)
+        return False
+    sdk.sync_tasks = sync_tasks
+
+    async def _test():
+        policy = PollingPolicy(initial=0.01, minimum=0.01, max_wait=0.2)
+        tasks = await sdk.wait_until_complete(policy=policy)
+        assert all(task.completed_at and task.is_timeout() for task in tasks)
+        assert [task.get_result() for task in tasks] == ['a', 'b']
+        assert 1 < len(syncs) < 20
+        assert sdk._memo_keys == {}
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_concat_v():
+    from io import BytesIO
+    from PIL import Image
+    from hitl_sdk.common import concat_v
+
+    def make(fmt, size, mode='RGB'):
+        img = BytesIO()
+        Image.new(mode, size).save(img, format=fmt)
+        return img.getvalue()
+
+    jpeg = make('JPEG', (400, 300))
+    assert concat_v([jpeg]) is jpeg
+    assert Image.open(BytesIO(concat_v([jpeg], quality=50))).size == (400, 300)
+    stitched = Image.open(BytesIO(concat_v([jpeg, make('PNG', (100, 50), 'RGBA')], max_width=200)))
+    assert (stitched.format, stitched.size) == ('JPEG', (200, 200))
+
+
+def test_result_cache(tmp_path):
+    from hitl_sdk.memo import MemoryResultStore, ResultCache, SqliteResultStore
+
+    for store in [MemoryResultStore(maxsize=1), SqliteResultStore(str(tmp_path / 'results.db'), maxsize=1)]:
+        cache = ResultCache(store)
+        key, hit = cache.lookup(Task(images=[b'crop'], field_name='name'), 'passport')
+        assert not hit
+        cache.set(key, 'John')
+
+        task = Task(images=[b'crop'], field_name='name')
+        assert cache.lookup(task, 'passport') == (key, True)
+        assert task.completed_at and task.get_result() == 'John'
+        assert not cache.lookup(Task(images=[b'crop'], field_name='surname'), 'passport')[1]
+
+        cache.set('other', 'Doe')
+        assert not cache.lookup(Task(images=[b'crop'], field_name='name'), 'passport')[1]
+
+
+def test_json_stream():
+    import base64
+    import json
+    from hitl_sdk.toloka.stream import json_stream
+
+    image = bytes(range(256)) * 3000
+    payload = [{'images': [image, 'aGVsbG8='], 'predict': 'тест', 'deadline_at': None}, {'images': []}]
+
+    async def _test():
+        return b''.join([chunk async for chunk in json_stream(payload, write_size=1000)])
+    body = asyncio.get_event_loop().run_until_complete(_test())
+    assert json.loads(body) == [
+        {'images': [base64.b64encode(image).decode(), 'aGVsbG8='], 'predict': 'тест', 'deadline_at': None},
+        {'images': []},
+    ]
+
+
+def test_create_tasks_chunks():
+    sdk = HitlSDK(host='http://localhost:8888', chunk_max_items=3, chunk_max_bytes=6000)
+    requests = []
+
+    async def request(method, data, params, stream):
+        requests.append([item['field_name'] for item in data])
+        if 'f7' in requests[-1]:
+            raise ValueError('chunk failed')
+        return [{'id': item['field_name']} for item in data]
+    sdk._request = request
+
+    async def _test():
+        from hitl_sdk.common import DocumentStruct
+        tasks = [Task(field_name=f'f{i}', images=[b'1' * (4000 if i == 4 else 10)]) for i in range(9)]
+        try:
+            await sdk.create_tasks(tasks, document_structure=DocumentStruct('passport', []))
+        except ValueError:
+            pass
+        else:
+            assert False
+        assert requests == [['f0', 'f1', 'f2'], ['f3'], ['f4'], ['f5', 'f6', 'f7'], ['f8']]
+        assert sorted(sdk.tasks) == ['f0', 'f1', 'f2', 'f3', 'f4', 'f8']
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_get_or_create_project_single_flight(tmp_path):
+    from hitl_sdk.handl.api import Handl, OperationType
+    from hitl_sdk.handl.projects import ProjectRegistry
+
+    calls = []
+
+    async def request(url, method='GET', json=None, **kw):
+        calls.append((method, url))
+        await asyncio.sleep(0.01)
+        if method == 'GET' and url.endswith('/projects'):
+            return [{'id': 'old', 'title': 'HITL_1__ocr', 'state': 'archived'}]
+        if method == 'GET':
+            return {'id': 'new', 'title': 'HITL_1__ocr', 'state': 'online'}
+        return {'id': 'new', 'title': 'HITL_1__ocr', 'state': 'online'}
+
+    def make_handl():
+        handl = Handl(url='', username='', password='', version=1,
+                      projects=ProjectRegistry(str(tmp_path / 'projects.json')))
+        handl._request = request
+        return handl
+
+    async def _test():
+        handl = make_handl()
+        projects = await asyncio.gather(*(handl.get_or_create_project(OperationType.ocr) for _ in range(10)))
+        assert {p['id'] for p in projects} == {'new'}
+        assert [method for method, _ in calls] == ['GET', 'POST', 'PUT']
+
+        assert (await make_handl().get_or_create_project(OperationType.ocr))['id'] == 'new'
+        assert len(calls) == 3
+        assert (await handl.get_or_create_project(OperationType.ocr, from_cache=False))['id'] == 'new'
+        assert calls[-1] == ('GET', '/projects/new')
+
+        async def no_connection(url, method='GET', **kw):
+            return None
+        handl._request = no_connection
+        try:
+            await handl.get_or_create_project(OperationType.ocr, from_cache=False)
+        except ConnectionError:
+            pass
+        else:
+            raise AssertionError('expected ConnectionError')
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_handl_login_single_flight():
+    from hitl_sdk.handl.api import Handl
+
+    handl = Handl(url='', username='', password='')
+    logins = []
+
+    async def login():
+        logins.append(1)
+        await asyncio.sleep(0.01)
+        handl._jwt_token_cached = str(len(logins))
+        handl._jwt_token_created_at = time.time()
+        return handl._jwt_token_cached
+    handl._login = login
+
+    async def _test():
+        headers = await asyncio.gather(*(handl._auth_headers() for _ in range(10)))
+        assert {h['authorization'] for h in headers} == {'Bearer 1'}
+        assert len(logins) == 1
+
+        # Close to expiry the current token is still served while a new one is fetched in background.
+        handl._jwt_token_created_at -= handl.token_ttl - handl.token_refresh_margin + 1
+        assert await handl._jwt_token() == '1'
+        await asyncio.sleep(0.02)
+        assert await handl._jwt_token() == '2'
+        assert len(logins) == 2
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_handl_login_retries_and_401():
+    from aiohttp import web
+    from hitl_sdk.handl.api import Handl
+    from hitl_sdk.testing import MockHandl
+
+    class Server(MockHandl):
+        captchas = 0
+        unauthorized = 0
+
+        async def _login(self, request):
+            if self.captchas:
+                self.captchas -= 1
+                return web.json_response({'error': 'Incorrect CAPTCHA'})
+            return await super()._login(request)
+
+        async def _list_projects(self, request):
+            if self.unauthorized:
+                self.unauthorized -= 1
+                return web.json_response({'error': 'unauthorized'}, status=401)
+            return await super()._list_projects(request)
+
+    async def _test():
+        async with Server() as server:
+            handl = Handl(url=server.url, username='', password='')
+            handl.login_attempts = 3
+            handl.login_delay = 0.
+            server.captchas = 2
+            assert await handl._list_projects() == []
+            assert server.requests['POST /login'] == 3
+
+            server.unauthorized = 1
+            assert await handl._list_projects() == []
+            assert server.requests['POST /login'] == 4
+
+            server.unauthorized = 10
+            try:
+                await handl._list_projects()
+            except PermissionError:
+                pass
+            else:
+                raise AssertionError('expected PermissionError')
+            assert server.requests['POST /login'] == 5
+            assert server.requests['GET /projects'] == 5
+
+            handl._jwt_token_cached = None
+            server.captchas = 10
+            try:
+                await handl._auth_headers()
+            except PermissionError:
+                pass
+            else:
+                raise AssertionError('expected PermissionError')
+            assert server.requests['POST /login'] == 8
+            await handl.close()
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_handl_upload_dedup():
+    from hitl_sdk.handl.api import Handl
+    from hitl_sdk.testing import MockHandl
+
+    async def _test():
+        async with MockHandl(latency=0.01) as server:
+            handl = Handl(url=server.url, username='', password='')
+            semaphore = asyncio.Semaphore(10)
+            uploads = await asyncio.gather(*(handl._upload(semaphore, f'{i}.jpg', b'1', 'pid') for i in range(5)))
+            uploads.append(await handl._upload(semaphore, '5.jpg', b'1', 'pid'))
+            assert len({u['uri'] for u in uploads}) == 1
+            assert server.requests['PUT /upload/{name}'] == 1
+            assert handl.upload_cache.stats() == {'size': 1, 'hits': 5, 'misses': 1, 'bytes_saved': 5}
+            await handl.close()
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_task_from_dict_matches_dataclasses_json():
+    from dataclasses_json.core import _decode_dataclass
+
+    item = {
+        'id': '1', 'state': 'completed', 'field_name': 'name', 'result': ['a', 'b'], 'predict_confidence': 0.5,
+        'created_at': '2019-12-06T21:00:46.123456+00:00', 'completed_at': '2019-12-06T21:05:46+03:00',
+        'deadline_at': 'Dec 6 2019 21:10', 'image': 'aGVsbG8=', 'tasks': [{'id': '2'}], 'unknown': 1,
+    }
+    assert Task.from_dict(item) == _decode_dataclass(Task, item, False)
+    assert item['tasks'] == [{'id': '2'}] and 'images' not in item
+
+
+def test_task_release_payload():
+    images = [b'page1', b'page2']
+    task = Task(image=images[0], images=images)
+    assert task.images == [b'page1', b'page2']
+
+    task.release_payload()
+    assert task.image is None and task.images == [] and task.uncut_images == []
+    other = Task(images=[b'page1', b'page2'])
+    other.release_payload()
+    assert task.image_hash and task.image_hash == other.image_hash
+
+
+def test_task_store():
+    import datetime
+    from hitl_sdk.store import TaskStore
+
+    store = TaskStore(max_completed=2)
+    for i in range(5):
+        store[str(i)] = Task(id=str(i))
+    assert store.in_work_count() == 5
+
+    now = datetime.datetime.utcnow()
+    for i in range(4):
+        store[str(i)].completed_at = now
+    store.reconcile()
+    assert store.in_work_count() == 1
+    assert list(store) == ['4', '2', '3']
+
+    store['4'] = Task(id='4', completed_at=now)
+    assert (store.in_work_count(), len(store), '2' in store) == (0, 2, False)
+
+
+def test_create_and_wait_keeps_evicted_tasks():
+    from hitl_sdk.common import PollingPolicy
+    from hitl_sdk.store import TaskStore
+    from hitl_sdk.testing import MockToloka
+
+    async def _test():
+        async with MockToloka(completion_delay=0.05) as server:
+            policy = PollingPolicy(initial=0.02, minimum=0.01)
+            async with HitlSDK(host=server.url, polling_policy=policy, tasks=TaskStore(max_completed=2)) as sdk:
+                tasks = await sdk.create_and_wait([Task(images=[b'1'], field_name=str(i)) for i in range(5)])
+                assert sorted(task.field_name for task in tasks) == [str(i) for i in range(5)]
+                assert all(task.completed_at for task in tasks)
+                assert len(sdk.tasks) == 2
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_sync_tasks_chunks():
+    sdk = HitlSDK(host='http://localhost:8888', sync_chunk_size=2)
+    for i in range(5):
+        sdk.tasks[str(i)] = Task(id=str(i))
+    requests = []
+
+    async def request(method, data, params):
+        requests.append(data['ids'])
+        if '2' in data['ids']:
+            raise ValueError('chunk failed')
+        return [{'id': i, 'completed_at': '2019-12-06T21:00:46'} for i in data['ids']]
+    sdk._request = request
+
+    async def _test():
+        assert await sdk.sync_tasks()
+        assert requests == [['0', '1'], ['2', '3'], ['4']]
+        assert sorted(sdk.tasks.in_flight()) == ['2', '3']
+        await sdk.sync_tasks()
+        assert requests[-1] == ['2', '3']
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_mock_toloka_create_and_wait():
+    from hitl_sdk.common import PollingPolicy
+    from hitl_sdk.testing import MockToloka
+
+    async def _test():
+        async with MockToloka(completion_delay=0.1) as server:
+            async with HitlSDK(host=server.url, polling_policy=PollingPolicy(initial=0.05, minimum=0.01)) as sdk:
+                tasks = await sdk.create_and_wait(
+                    [Task(images=[b'1'], field_name='a', predict='x'), Task(images=[b'2'], field_name='b')],
+                )
+        assert sorted(task.result for task in tasks) == ['human', 'x']
+        assert server.requests['POST /tasks'] == 1
+        assert server.requests['GET /tasks'] >= 1
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_metrics():
+    from hitl_sdk.common import PollingPolicy
+    from hitl_sdk.metrics import MetricsRegistry, format_prometheus, set_metrics
+    from hitl_sdk.testing import MockToloka
+
+    registry = set_metrics(MetricsRegistry())
+
+    async def _test():
+        async with MockToloka(completion_delay=0.05) as server:
+            async with HitlSDK(host=server.url, polling_policy=PollingPolicy(initial=0.05, minimum=0.01)) as sdk:
+                await sdk.create_and_wait([Task(images=[b'1'], field_name='a')])
+    try:
+        asyncio.get_event_loop().run_until_complete(_test())
+    finally:
+        set_metrics(None)
+
+    snapshot = registry.snapshot()
+    requests = {tuple(sorted(s['labels'].items())): s['value'] for s in snapshot['hitl_requests_total']}
+    assert requests[(('backend', 'toloka'), ('endpoint', 'tasks'), ('method', 'POST'), ('status', '200'))] == 1
+    assert all(s['value'] == 0 for s in snapshot['hitl_requests_in_flight'])
+    assert snapshot['hitl_task_wait_seconds'][0]['count'] == 1
+    text = format_prometheus(registry)
+    assert '# TYPE hitl_request_seconds histogram' in text
+    assert 'hitl_request_seconds_bucket{backend="toloka",endpoint="tasks",method="POST",le="+Inf"} 1' in text
+
+
+def test_tracing():
+    from hitl_sdk.common import PollingPolicy
+    from hitl_sdk.testing import MockToloka
+    from hitl_sdk.tracing import RecordingTracer, set_tracer
+
+    spans = []
+    set_tracer(RecordingTracer(spans.append))
+
+    async def _test():
+        async with MockToloka(completion_delay=0.05) as server:
+            async with HitlSDK(host=server.url, polling_policy=PollingPolicy(initial=0.05, minimum=0.01)) as sdk:
+                await sdk.create_and_wait([Task(images=[b'1'], field_name='a')], document_id='doc')
+    try:
+        asyncio.get_event_loop().run_until_complete(_test())
+    finally:
+        set_tracer(None)
+
+    by_name = {span.name: span for span in spans}
+    root = by_name['create_tasks']
+    assert root.parent_id is None and root.tags == {'document_id': 'doc'}
+    assert by_name['register_tasks'].parent_id == root.span_id
+    assert by_name['wait_until_complete'].parent_id == root.span_id
+    assert by_name['poll'].parent_id == by_name['wait_until_complete'].span_id
+    assert {span.trace_id for span in spans} == {root.trace_id}
+    assert all(span.tags['document_id'] == 'doc' for span in spans)
+
+
+def test_lazy_backend_import():
+    import os
+    import subprocess
+    import sys
+
+    code = (
+        'import sys, hitl_sdk\n'
+        'assert "hitl_sdk.toloka.sdk" not in sys.modules\n'
+        'assert hitl_sdk.SDK is hitl_sdk.TolokaSDK\n'
+        'assert not {"hitl_sdk.handl.sdk", "numpy", "PIL"} & set(sys.modules)\n'
+    )
+    env = dict(os.environ, HITL_BACKEND='toloka')
+    subprocess.run([sys.executable, '-c', code], env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_document_manager_shares_polls():
+    from hitl_sdk.common import PollingPolicy
+    from hitl_sdk.testing import MockToloka
+    from hitl_sdk.toloka.manager import TolokaDocumentManager
+
+    async def _test():
+        async with MockToloka(completion_delay=0.2) as server:
+            async with HitlSDK(host=server.url) as sdk:
+                sdk.tasks['own'] = Task(id='own')
+                manager = TolokaDocumentManager(sdk, PollingPolicy(initial=0.05, minimum=0.01))
+                documents = await asyncio.gather(*(
+                    manager.create_and_wait([b'1'], document_id=str(i))
+                    for i in range(20)
+                ))
+        assert [document.document_id for document in documents] == [str(i) for i in range(20)]
+        assert all(document.completed_at for document in documents)
+        assert (len(manager.documents), len(manager.sdk.tasks), list(sdk.tasks)) == (0, 0, ['own'])
+        # One batched tasks request per poll, each document is fetched once when its tasks are done.
+        assert server.requests['GET /tasks'] < 10
+        assert server.requests['GET /document'] == 20
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_document_manager_fails_waiters():
+    from hitl_sdk.common import PollingPolicy
+    from hitl_sdk.toloka.manager import TolokaDocumentManager
+
+    async def _test():
+        sdk = HitlSDK(host='http://localhost:8888')
+        manager = TolokaDocumentManager(sdk, PollingPolicy(minimum=0.01))
+
+        async def poll(documents):
+            return False
+        manager._poll = poll
+
+        def resolve():
+            raise RuntimeError('broken')
+        manager._resolve = resolve
+
+        results = await asyncio.gather(
+            manager.wait(Task(id='1')), manager.wait(Task(id='2')), return_exceptions=True,
+        )
+        assert [repr(r) for r in results] == [repr(RuntimeError('broken'))] * 2
+        await sdk.close()
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_handl_create_task_raises_upload_error():
+    from hitl_sdk.handl.api import Handl
+
+    handl = Handl(url='http://localhost:8888', username='', password='')
+
+    async def request(url, method='GET', **kw):
+        raise KeyError('uri')
+    handl._request = request
+
+    async def _test():
+        try:
+            await handl.create_task('a.jpg', b'1', '', 'pid')
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('upload error is not raised')
+    asyncio.get_event_loop().run_until_complete(_test())
+
+
+def test_handl_create_tasks_skips_broken_image():
+    import io
+    from PIL import Image
+    from hitl_sdk.handl import sdk as handl_sdk
+    from hitl_sdk.handl.api import Handl
+
+    buf = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buf, format='JPEG')
+    handl = Handl(url='http://localhost:8888', username='', password='')
+    uploaded = []
+
+    async def get_or_create_project(operation):
+        return {'id': 'pid'}
+
+    async def create_tasks_bulk(items, project_id, max_concurrency=10):
+        uploaded.extend(name for name, _, _ in items)
+        return [{'id': str(i)} for i in range(len(items))]
+    handl.get_or_create_project = get_or_create_project
+    handl.create_tasks_bulk = create_tasks_bulk
+    handl_sdk.set_handl(handl)
+
+    async def _test():
+        tasks = [Task(images=[buf.getvalue()], field_name='a'), Task(images=[b'broken'], field_name='b'),
+                 Task(images=[buf.getvalue()], field_name='c')]
+        created = await handl_sdk.SDK().create_tasks(tasks, only_created=True)
+        assert [task.field_name for task in created] == ['a', 'c']
+        assert tasks[1].state == 'error'
+        assert len(uploaded) == 2
+    try:
+        asyncio.get_event_loop().run_until_complete(_test())
+    finally:
+        handl_sdk.set_handl(None)
+
+
+def test_handl_module_client_assignment():
+    from hitl_sdk.handl import sdk as handl_sdk
+    from hitl_sdk.handl.api import Handl
+
+    client = Handl(url='', username='', password='')
+    try:
+        handl_sdk.handl = client
+        assert handl_sdk.get_handl() is client
+        other = Handl(url='', username='', password='')
+        handl_sdk.set_handl(other)
+        assert handl_sdk.get_handl() is other and handl_sdk.handl is other
+    finally:
+        handl_sdk.set_handl(None)
+
+
+def test_result_poller_runs_outside_caller_trace():
+    from hitl_sdk.handl.api import Handl
+    from hitl_sdk.tracing import RecordingTracer, set_tracer, span
+
+    handl = Handl(url='http://localhost:8888', username='', password='')
+    handl.poll_interval = 0.01
+    calls = []
+
+    async def get_results(project_id):
+        calls.append(project_id)
+        return [{'id': str(i), 'payload': {'text': str(i)}} for i in range(len(calls))]
+    handl.get_results = get_results
+
+    spans = []
+    set_tracer(RecordingTracer(spans.append))
+
+    async def wait(document_id, task_id):
+        with span('document', document_id=document_id):
+            await handl.wait_result('pid', task_id)
+
+    try:
+        asyncio.get_event_loop().run_until_complete(asyncio.gather(wait('doc0', '0'), wait('doc1', '2')))
+    finally:
+        set_tracer(None)
+
+    documents = {s.tags['document_id']: s for s in spans if s.name == 'document'}
+    waits = {s.tags['document_id']: s for s in spans if s.name == 'wait_result'}
+    assert {d: waits[d].trace_id for d in waits} == {d: documents[d].trace_id for d in documents}
+    polls = [s for s in spans if s.name == 'poll_results']
+    assert polls and all(s.parent_id is None and 'document_id' not in s.tags for s in polls)
+
+
+def test_result_cache_matches_reordered_response():
+    from hitl_sdk.memo import ResultCache
+
+    cache = ResultCache()
+    sdk = HitlSDK(host='http://localhost:8888', result_cache=cache)
+
+    async def request(method, data, params, stream=False):
+        return [
+            {'id': str(i), 'field_name': item['field_name'], 'result': item['field_name'] + '-answer',
+             'completed_at': '2019-12-06T21:00:46'}
+            for i, item in reversed(list(enumerate(data)))
+        ]
+    sdk._request = request
+
+    async def _test():
+        await sdk.create_tasks([Task(images=[b'a'], field_name='a'), Task(images=[b'b'], field_name='b')])
+    asyncio.get_event_loop().run_until_complete(_test())
+
+    assert cache.get(cache.key([b'a'], 'a', None)) == 'a-answer'
+    assert cache.get(cache.key([b'b'], 'b', None)) == 'b-answer'
+    assert sdk._match_memo_keys([{'field_name': None}] * 2, ['k1', 'k2'], [{'field_name': None}]) == [None]